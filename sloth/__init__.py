@@ -38,22 +38,24 @@ class RoleLookup:
         return qs.apply_role_lookups(user)
 
     def apply(self, user):
+        from sloth.api.models import RoleContext
+        roles = RoleContext.get(user)
         for names, scopes in self.lookups:
-            for role in user.roles.all():
-                if role.name in names:
-                    if scopes:
-                        for scope_value_attr, scope_key in scopes.items():
-                            if role.scope_key == scope_key:
-                                scope_value = getattr(self.instance, scope_value_attr)
-                                scope_value = scope_value if type(scope_value) == int else scope_value.pk
-                                if role.scope_value == scope_value:
-                                    return True
-                    else:
-                        return True
+            if roles.contains(*names):
+                if scopes:
+                    for scope_value_attr, scope_key in scopes.items():
+                        scope_values = [value for name in names for value in roles.get_scope_values(name, scope_key)]
+                        if scope_values:
+                            scope_value = getattr(self.instance, scope_value_attr)
+                            scope_value = scope_value if type(scope_value) == int else scope_value.pk
+                            if scope_value in scope_values:
+                                return True
+                else:
+                    return True
         return False
 
 
-def meta(verbose_name=None, renderer=None, assyncronous=False, cache=0, **metadata):
+def meta(verbose_name=None, renderer=None, assyncronous=False, cache=0, parallel=False, cache_scope='user', depends=(), warm=False, **metadata):
     def decorate(func):
         if verbose_name is not None:
             setattr(func, '__verbose_name__', verbose_name)
@@ -63,6 +65,12 @@ def meta(verbose_name=None, renderer=None, assyncronous=False, cache=0, **metada
             setattr(func, '__assyncronous__', True)
         if cache:
             setattr(func, '__cache__', cache)
+            setattr(func, '__cache_scope__', cache_scope)
+            setattr(func, '__depends__', depends)
+            if warm:
+                setattr(func, '__warm__', True)
+        if parallel:
+            setattr(func, '__parallel__', True)
         if metadata:
             setattr(func, '__metadata__', metadata)
 
@@ -86,6 +94,8 @@ def initialize():
             validate_model(model)
         except ProgrammingError:
             pass
+        if hasattr(model, 'get_permission_hooks'):
+            model.get_permission_hooks()
 
 
 class BaseManager(manager.BaseManager):
@@ -135,5 +145,6 @@ models.QuerySet = QuerySet
 models.Manager = Manager
 
 setattr(options, 'DEFAULT_NAMES', options.DEFAULT_NAMES + (
-    'icon', 'fieldsets', 'edit_fieldsets', 'select_template', 'select_fields', 'search_fields', 'autouser', 'logging'
+    'icon', 'fieldsets', 'edit_fieldsets', 'select_template', 'select_fields', 'search_fields', 'autouser', 'logging',
+    'rollups', 'rollup_sums'
 ))
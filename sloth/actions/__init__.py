@@ -609,6 +609,19 @@ class Action(metaclass=ActionMetaclass):
             ### return cls.check_permission(checker, request.user) if has_permission is None else has_permission
         return True
 
+    @classmethod
+    def check_fake_permission_bulk(cls, request, instances, instantiator=None):
+        # returns the pks of the instances the action is allowed for, calling has_permission_bulk(user, objects)
+        # once when the action defines it instead of has_permission(user) for each instance
+        if request is None:
+            return {instance.pk for instance in instances}
+        if hasattr(cls, 'has_permission_bulk'):
+            checker = PermissionChecker(request, None, instantiator, getattr(cls, 'Meta', None))
+            return {getattr(obj, 'pk', obj) for obj in cls.has_permission_bulk(checker, request.user, instances)}
+        return {
+            instance.pk for instance in instances if cls.check_fake_permission(request, instance, instantiator)
+        }
+
     def __str__(self):
         return self.html()
 
@@ -1,5 +1,6 @@
 import inspect
 from django.apps import apps
+from django.conf import settings
 from django.core.cache import cache
 from django.http import HttpResponseRedirect
 from django.template.loader import render_to_string
@@ -10,8 +11,13 @@ from sloth.utils import pretty
 from ..actions import Action, ACTIONS
 from ..core.valueset import ValueSet
 from ..core.queryset import QuerySet
+from ..core.cache import get_skeleton_key, cached_counts
 
 DASHBOARDS = []
+SKELETON = (
+    'navbar', 'header', 'footer', 'styles', 'scripts', 'floating', 'navigation', 'actions', 'menu', 'links', 'tools',
+    'search', 'plus'
+)
 
 
 class DashboardType(type):
@@ -28,6 +34,8 @@ class Dashboard(metaclass=DashboardType):
         self.redirect_url = None
         self.redirect_message = None
         self.request = request
+        # the static parts are not loaded again when they were cached by Dashboards
+        self.skeleton = getattr(request, 'dashboard_skeleton', False)
         self.data = dict(
             info=[], warning=[], search=[], menu=[], links=[], shortcuts=[], cards=[], plus=[], navbar={},
             floating=[], navigation=[], settings=[], top=[], center=[], right=[], bottom=[], actions=[], tools=[], header={}, footer={},
@@ -35,6 +43,8 @@ class Dashboard(metaclass=DashboardType):
         )
         self.defined_apps = {}
         self.enabled_apps = set()
+        # items whose counts are computed at once by Dashboards
+        self.counters = []
         if self.request.user.is_authenticated:
             self.load(request)
         if self.request.path == '/app/dashboard/':
@@ -55,29 +65,39 @@ class Dashboard(metaclass=DashboardType):
         self.redirect_message = message
 
     def navbar(self, title=None, icon=None, favicon=None):
-        cache.set('title', title)
-        cache.set('icon', icon)
-        cache.set('favicon', favicon)
+        if self.skeleton:
+            return
+        # read by the manifest and icon views, also while the skeletons cached without calling this are valid
+        cache.set('title', title, None)
+        cache.set('icon', icon, None)
+        cache.set('favicon', favicon, None)
         self.data['navbar'].update(title=title, icon=icon, favicon=favicon)
 
     def login(self, logo=None, title=None, mask=None, two_factor=False, actions=()):
-        cache.set('login', dict(logo=logo, title=title, mask=mask, actions=actions))
+        # the settings menu depends on the state of the user (e.g. 2FA activation) and is never part of the skeleton
         if two_factor:
             self.settings_menu('activate_2f_authentication', 'deactivate_2f_authentication')
+        if self.skeleton:
+            return
+        cache.set('login', dict(logo=logo, title=title, mask=mask, actions=actions), None)
 
     def styles(self, *urls):
-        self.data['styles'].extend(urls)
+        if not self.skeleton:
+            self.data['styles'].extend(urls)
 
     def scripts(self, *urls):
-        self.data['scripts'].extend(urls)
+        if not self.skeleton:
+            self.data['scripts'].extend(urls)
 
     def libraries(self, fontawesome=False, materialicons=False):
+        if self.skeleton:
+            return
         if fontawesome:
-            cache.set('fontawesome', True)
+            cache.set('fontawesome', True, None)
             self.scripts('/static/icons/fontawesome/fontawesome.min.js')
             self.styles('/static/icons/fontawesome/fontawesome.min.css')
         if materialicons:
-            cache.set('materialicons', True)
+            cache.set('materialicons', True, None)
             self.styles('/static/icons/materialicons/materialicons.css')
 
     def web_push_notification(self, activate=False):
@@ -85,10 +105,12 @@ class Dashboard(metaclass=DashboardType):
             self.scripts('/static/js/wpn.min.js')
 
     def header(self, logo=None, title=None, text=None, shadow=True):
-        self.data['header'].update(logo=logo, title=title, text=text, shadow=shadow)
+        if not self.skeleton:
+            self.data['header'].update(logo=logo, title=title, text=text, shadow=shadow)
 
     def footer(self, title=None, text=None, version=None):
-        self.data['footer'].update(title=title, text=text, version=version)
+        if not self.skeleton:
+            self.data['footer'].update(title=title, text=text, version=version)
 
     def to_item(self, model, count=True):
         return
@@ -96,6 +118,8 @@ class Dashboard(metaclass=DashboardType):
     def _load(self, key, items, modal=False, count=False, app=None):
         new_item = None
         allways = 'floating', 'navigation', 'settings', 'actions', 'menu', 'links', 'tools', 'search', 'plus'
+        if self.skeleton and key in SKELETON:
+            return new_item
         for cls in items:
             if '.' in cls:
                 modal = False if key in ('tools', 'settings') else modal
@@ -136,15 +160,20 @@ class Dashboard(metaclass=DashboardType):
                                 add_item = add_item and not item['url'] == url
                             if add_item:
                                 new_item = dict(
-                                    url=url, label=label, modal=modal or key == 'plus',
-                                    count=cls.objects.all().apply_role_lookups(self.request.user).count() if count else None,
+                                    url=url, label=label, modal=modal or key == 'plus', count=None,
                                     icon=getattr(cls.metaclass(), 'icon', None),
                                     app=app
                                 )
+                                if count:
+                                    self.counters.append(
+                                        (new_item, cls.objects.all().apply_role_lookups(self.request.user))
+                                    )
                                 self.data[key].append(new_item)
         return new_item
 
     def _item(self, key, url, label, icon, count=None, app=None):
+        if self.skeleton and key in SKELETON:
+            return
         self.data[key].append(
             dict(url=url, label=label, count=count, icon=icon, app=app)
         )
@@ -170,14 +199,14 @@ class Dashboard(metaclass=DashboardType):
         for key, qs in kwargs.items():
             if 'session_lookups' not in self.request.session:
                 self.request.session['session_lookups'] = {}
-                self.request.session.save()
             if key not in self.request.session['session_lookups'] :
                 self.request.session['session_lookups'][key] = dict(
                     choices=[[obj.pk, str(obj)] for obj in qs],
                     value=None,
                     label=qs.model.metaclass().verbose_name
                 )
-                self.request.session.save()
+                # saved once by the session middleware at the end of the request
+                self.request.session.modified = True
 
     def top_menu(self, *items, modal=False, app=None):
         self._load('links', items, modal=modal, app=app)
@@ -204,6 +233,8 @@ class Dashboard(metaclass=DashboardType):
             self._item('actions', url, label, icon, app=app)
 
     def add_app(self, label, icon, hide=False):
+        if self.skeleton:
+            return
         url = '/app/?toggle-application={}'.format(label)
         self.defined_apps[label] = dict(label=label, icon=icon, hide=hide, url=url, enabled=False)
 
@@ -315,6 +346,16 @@ class Dashboards:
         self.data['navigation'].append(
             dict(url='/app/dashboard/', label='Principal', icon='house', app=None)
         )
+        key = skeleton = None
+        timeout = getattr(settings, 'DASHBOARD_CACHE_TIMEOUT', 0)
+        # without DEPLOY_TOKEN (see the "sloth.E001" system check) the skeletons are not cached
+        deploy_token = getattr(settings, 'DEPLOY_TOKEN', None)
+        if timeout and deploy_token and request.user.is_authenticated and hasattr(request, 'session'):
+            key = get_skeleton_key(request, mobile(request))
+            skeleton = cache.get(key)
+        request.dashboard_skeleton = skeleton is not None
+        if skeleton is not None:
+            self.apps = skeleton['apps']
         for cls in DASHBOARDS:
             dashboard = cls(request)
             if dashboard.redirect_url:
@@ -325,6 +366,8 @@ class Dashboards:
             for name in dashboard.enabled_apps:
                 self.apps[name]['enabled'] = True
             self.dashboards.append(dashboard)
+        if skeleton is not None:
+            self.data.update(skeleton['data'])
 
         if 'toggle-application' in request.GET:
             for name in self.apps:
@@ -335,10 +378,16 @@ class Dashboards:
                     else:
                         request.session['app_name'] = name
                         request.session['app_icon'] = self.apps[name]['icon']
-                    request.session.save()
                     break
             raise ReadyResponseException(HttpResponseRedirect('/app/dashboard/'))
 
+        counters = [counter for dashboard in self.dashboards for counter in dashboard.counters]
+        for (item, _), total in zip(counters, cached_counts([qs for _, qs in counters])):
+            item['count'] = total
+
+        if skeleton is not None:
+            return
+
         if self.request.user.is_superuser:
             self.superuser()
 
@@ -347,6 +396,9 @@ class Dashboards:
         else:
             self.data['menu'] = self.create_menu(render=False)
 
+        if key:
+            cache.set(key, dict(apps=self.apps, data={name: self.data[name] for name in SKELETON}), timeout)
+
     def main(self):
         for dashboard in self.dashboards:
             if dashboard.view.__func__ != Dashboard.view:
@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+from django.apps import apps
+from django.core.management.base import BaseCommand
+
+from sloth.core.rollup import get_rollups, rebuild
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the rollup tables of the models declaring Meta.rollups'
+
+    def add_arguments(self, parser):
+        parser.add_argument('models', nargs='*', type=str, help='app_label.model_name')
+
+    def handle(self, *args, **options):
+        if options['models']:
+            models = [apps.get_model(name) for name in options['models']]
+        else:
+            models = [model for model in apps.get_models() if get_rollups(model)]
+        for model in models:
+            rebuild(model)
+            self.stdout.write('Rollups of {} rebuilt'.format(model._meta.label))
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+from django.apps import apps
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, DEFAULT_DB_ALIAS
+
+from sloth.core.search import get_backend_cls, get_exists_key
+
+
+class Command(BaseCommand):
+    help = 'Creates, refreshes or drops the full-text indexes of the models declaring Meta.search_fields'
+
+    def add_arguments(self, parser):
+        parser.add_argument('models', nargs='*', type=str, help='app_label.model_name')
+        parser.add_argument('--refresh', action='store_true', help='Rebuilds existing indexes')
+        parser.add_argument('--drop', action='store_true', help='Removes the indexes')
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS)
+
+    def handle(self, *args, **options):
+        using = options['database']
+        cls = get_backend_cls(connections[using].vendor)
+        if cls is None:
+            raise CommandError('There is no search backend for {}'.format(connections[using].vendor))
+        if options['models']:
+            models = [apps.get_model(name) for name in options['models']]
+        else:
+            models = [model for model in apps.get_models() if getattr(model._meta, 'search_fields', None)]
+        for model in models:
+            backend = cls(model, using=using)
+            if not backend.fields:
+                continue
+            if options['drop']:
+                backend.drop()
+                self.stdout.write('Search index of {} dropped'.format(model._meta.label))
+            elif options['refresh'] and backend.exists():
+                backend.refresh()
+                self.stdout.write('Search index of {} refreshed'.format(model._meta.label))
+            else:
+                backend.create()
+                self.stdout.write('Search index of {} created'.format(model._meta.label))
+            cache.delete(get_exists_key(model, using))
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+import time
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from sloth.core.warmer import warm_all
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the attributes decorated with @meta(cache=N, warm=True) that are about to expire'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=int, default=0, help='Runs forever waiting the given seconds between each round')
+
+    def handle(self, *args, **options):
+        interval = options['interval']
+        while True:
+            total = warm_all(margin=interval)
+            connections.close_all()
+            self.stdout.write('{} attribute(s) warmed'.format(total))
+            if not interval:
+                break
+            time.sleep(interval)
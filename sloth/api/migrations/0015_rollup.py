@@ -0,0 +1,32 @@
+# Generated by Django 4.1 on 2026-10-18 15:35
+
+from django.db import migrations, models
+import sloth.core.base
+import sloth.db.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0014_email'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Rollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('model', sloth.db.models.CharField(max_length=100, verbose_name='Modelo')),
+                ('dimensions', sloth.db.models.CharField(max_length=255, verbose_name='Dimensões')),
+                ('aggregate', sloth.db.models.CharField(max_length=100, verbose_name='Agregação')),
+                ('key', sloth.db.models.CharField(max_length=255, verbose_name='Chave')),
+                ('value', sloth.db.models.DecimalField(decimal_places=8, default=0, max_digits=32, verbose_name='Valor')),
+            ],
+            options={
+                'verbose_name': 'Agregação',
+                'verbose_name_plural': 'Agregações',
+                'unique_together': {('model', 'dimensions', 'aggregate', 'key')},
+            },
+            bases=(models.Model, sloth.core.base.ModelMixin),
+        ),
+    ]
@@ -109,12 +109,7 @@ class RoleManager(models.Manager):
 
     def contains(self, *names):
         if 'instance' in self._hints:
-            if not hasattr(self._hints['instance'], '_cached_role_names'):
-                self._hints['instance']._cached_role_names = self.filter(active=True).values_list('name', flat=True)
-            for name in names:
-                if name in self._hints['instance']._cached_role_names:
-                    return True
-            return False
+            return RoleContext.get(self._hints['instance']).contains(*names)
         return self.filter(active=True, name__in=names).exists()
 
     def names(self):
@@ -154,6 +149,32 @@ class Role(models.Model):
             return apps.get_model(self.scope_type).objects.filter(pk=self.scope_value).first()
 
 
+class RoleContext(object):
+    # active roles of a user, loaded once and shared by every role check made with the same user instance,
+    # which lives as long as the request
+
+    def __init__(self, user):
+        self.roles = tuple(Role.objects.filter(user_id=user.pk, active=True).order_by(
+            'name', 'scope_key', 'scope_value').values_list('name', 'scope_key', 'scope_value')
+        ) if user.pk else ()
+        self.names = {name for name, _, _ in self.roles}
+        self.scopes = {}
+        for name, scope_key, scope_value in self.roles:
+            self.scopes.setdefault((name, scope_key), []).append(scope_value)
+
+    @classmethod
+    def get(cls, user):
+        if not hasattr(user, '_role_context'):
+            user._role_context = cls(user)
+        return user._role_context
+
+    def contains(self, *names):
+        return not self.names.isdisjoint(names)
+
+    def get_scope_values(self, name, scope_key):
+        return self.scopes.get((name, scope_key), [])
+
+
 class Scope(models.Model):
     name = models.CharField(max_length=50, verbose_name='Nome')
     description = models.TextField(verbose_name='Descrição')
@@ -276,6 +297,22 @@ class Task(models.Model):
         return user.is_superuser or self.user == user
 
 
+class Rollup(models.Model):
+    model = models.CharField(verbose_name='Modelo', max_length=100)
+    dimensions = models.CharField(verbose_name='Dimensões')
+    aggregate = models.CharField(verbose_name='Agregação', max_length=100)
+    key = models.CharField(verbose_name='Chave')
+    value = models.DecimalField(verbose_name='Valor', max_digits=32, decimal_places=8, default=0)
+
+    class Meta:
+        verbose_name = 'Agregação'
+        verbose_name_plural = 'Agregações'
+        unique_together = ('model', 'dimensions', 'aggregate', 'key'),
+
+    def __str__(self):
+        return '{} ({})'.format(self.model, self.dimensions)
+
+
 class PushNotification(models.Model):
     user = models.OneToOneField(DjangoUser, verbose_name='Usuário', on_delete=models.CASCADE, related_name='push_notification')
     subscription = models.JSONField(verbose_name='Dados da Inscrição')
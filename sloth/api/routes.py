@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+
+from functools import lru_cache
+from django.apps import apps
+from django.conf import settings
+from ..core.queryset import QuerySet
+
+
+@lru_cache()
+def get_routes():
+    # first level of the route table following "dashboard/": the installed apps point to their models and the
+    # models of the "api" app are reachable without the app label (apps take precedence in case of conflict)
+    routes = {}
+    for model in apps.get_models():
+        if model.metaclass().app_label == 'api':
+            routes[model.metaclass().model_name] = model
+    for label in settings.INSTALLED_APPS:
+        routes[label.split('.')[-1]] = {}
+    for model in apps.get_models():
+        models = routes.get(model.metaclass().app_label)
+        if isinstance(models, dict):
+            models[model.metaclass().model_name] = model
+    return routes
+
+
+def resolve(tokens):
+    # consumes the tokens that identify a model (e.g. ["base", "servidor"] or ["user"]) and returns it or None
+    route = get_routes().get(tokens[0])
+    if isinstance(route, dict):
+        if len(tokens) < 2 or tokens[1] not in route:
+            return None
+        tokens.pop(0)
+        route = route[tokens[0]]
+    if route is not None:
+        tokens.pop(0)
+    return route
+
+
+def get_queryset(model):
+    queryset = model.objects.view()
+    if isinstance(queryset, QuerySet):
+        queryset = queryset.default_actions().expand().admin()
+    return queryset
+
+
+@lru_cache()
+def get_allowed_attrs(model):
+    # the attributes reachable from the model's listing only depend on its definition
+    return frozenset(get_queryset(model).get_allowed_attrs())
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 import json
+import hmac
 import base64
 import traceback
 from datetime import datetime
@@ -10,29 +11,33 @@ from oauth2_provider.models import AccessToken
 from sloth import threadlocals
 from django.core.cache import cache
 from django.http import QueryDict
-from django.apps import apps
 from oauth2_provider.oauth2_backends import get_oauthlib_core
 from ..core.valueset import ValueSet
 from ..test import SeleniumTestCase
-from ..utils.http import ApiResponse
-from django.contrib.auth import authenticate
+from ..utils.http import ApiResponse, StreamingApiResponse
+from django.contrib.auth import authenticate, get_user_model
 from ..api import OpenApi
 from django.conf import settings
 from django.contrib import messages
 from django.core.exceptions import PermissionDenied, ObjectDoesNotExist
-from django.http import JsonResponse, HttpResponseForbidden, HttpResponse, HttpResponseRedirect
+from django.http import JsonResponse, HttpResponseForbidden, HttpResponse, HttpResponseRedirect, HttpResponseNotModified
+from django.utils.cache import patch_vary_headers
+from django.utils.http import parse_etags, quote_etag
 from django.shortcuts import render
 from django.template.loader import render_to_string
 from django.views.decorators.csrf import csrf_exempt
 from ..actions import Action, ACTIONS, EXPOSE
 from .templatetags.tags import is_ajax
 from ..core.queryset import QuerySet
+from ..core.cache import TableRecorder, get_cached_etag, set_cached_etag, get_credential, set_credential
 from sloth.api.exceptions import JsonReadyResponseException, HtmlReadyResponseException, ReadyResponseException
 from .dashboard import Dashboards, Dashboard
+from . import routes
 from .. import initialize
 
 
 initialize()
+routes.get_routes()
 
 
 def logger(func):
@@ -63,20 +68,20 @@ def app(request, path):
         ctx['DISPLAY_FAKE_MOUSE'] = 1 if SeleniumTestCase.EXPLAIN else 0
         ctx['LOG_TEST_ACTIONS'] = 1 if SeleniumTestCase.LOG_ACTION == 2 else 0
         if request.user.is_authenticated and request.path.startswith('/app/') and not is_ajax(request):
-            if 'stack' not in request.session:
-                request.session['stack'] = []
+            # the stack is replaced rather than changed in place, so the session is only written (once, by the
+            # session middleware) when the navigation actually changes it, e.g. not when a page is reloaded
+            stack = request.session.get('stack')
             if request.path == '/app/dashboard/':
-                request.session['stack'].clear()
-                request.session['stack'].append(request.path)
-            elif request.path in request.session['stack']:
-                i = request.session['stack'].index(request.path)
-                request.session['stack'] = request.session['stack'][0:i + 1]
+                new_stack = [request.path]
+            elif stack and request.path in stack:
+                new_stack = stack[0:stack.index(request.path) + 1]
             else:
-                request.session['stack'].append(request.path)
-            request.session.save()
-            referrer = request.session['stack'][-2] if len(request.session['stack']) > 1 else None
+                new_stack = (stack or []) + [request.path]
+            if new_stack != stack:
+                request.session['stack'] = new_stack
+            referrer = new_stack[-2] if len(new_stack) > 1 else None
             ctx.update(referrer=referrer)
-        data = dispatcher(request, path)
+        data = dispatcher(request, path, ctx['dashboard'])
         if isinstance(data, Action):
             ctx.update(form=data)
             if data.response:
@@ -136,13 +141,34 @@ def endpoint(func):
             if request.method == 'OPTIONS':
                 return ApiResponse({})
             if is_authenticated(request) or request.path.endswith('/login/'):
-                data = func(request, *args, **kwargs)
-                wrap = request.path.startswith('/meta')
-                serialized = data.serialize(wrap=wrap)
+                conditional = request.method == 'GET' and request.user.is_authenticated
+                if conditional and 'If-None-Match' in request.headers:
+                    etag = get_cached_etag(request)
+                    if etag and quote_etag(etag) in parse_etags(request.headers['If-None-Match']):
+                        response = HttpResponseNotModified()
+                        response['ETag'] = quote_etag(etag)
+                        patch_vary_headers(response, ['Accept'])
+                        return response
+                recorder = TableRecorder()
+                with recorder.record():
+                    data = func(request, *args, **kwargs)
+                    wrap = request.path.startswith('/meta')
+                    stream = StreamingApiResponse.get_format(request)
+                    if stream and not wrap and isinstance(data, QuerySet):
+                        response = StreamingApiResponse(data.stream(), stream)
+                        patch_vary_headers(response, ['Accept'])
+                        return response
+                    serialized = data.serialize(wrap=wrap)
                 if 0 and request.path == '/meta/dashboard/':
                     serialized = Dashboards(request).serialize(serialized)
                 # from pprint import pprint; pprint(serialized)
-                return ApiResponse(serialized, safe=False)
+                response = ApiResponse(serialized, safe=False)
+                etag = set_cached_etag(request, recorder) if conditional else None
+                if etag:
+                    response['ETag'] = quote_etag(etag)
+                    response['Cache-Control'] = 'private, no-cache'
+                patch_vary_headers(response, ['Accept'])
+                return response
             else:
                 return ApiResponse(
                     dict(type='message', text='Usuário não autenticado', style='warning'), status=403
@@ -203,11 +229,17 @@ def is_authenticated(request):
         if 'Authorization' in request.headers:
             authorization = request.headers['Authorization']
             token = authorization.split(' ')[-1]
+            if not authorization.startswith('Bearer '):
+                credential = get_credential(authorization)
+                if credential:
+                    request.user, request.access_token = credential
+                    return True
             if authorization.startswith('Basic '):
                 username, password = base64.b64decode(token).decode().split(':')
                 user = authenticate(request, username=username, password=password)
                 if user:
                     request.user = user
+                    set_credential(authorization, user)
                     return True
             elif authorization.startswith('Bearer '):
                 valid, req = get_oauthlib_core().verify_request(request, scopes=[])
@@ -220,14 +252,24 @@ def is_authenticated(request):
                 if access_token:
                     request.user = access_token.user
                     request.access_token = access_token
+                    set_credential(authorization, access_token.user, access_token)
                     return True
+            elif authorization.startswith('ApiKey '):
+                # keys of machine clients defined in settings.API_KEYS as a mapping of keys to usernames
+                for key, username in getattr(settings, 'API_KEYS', {}).items():
+                    if hmac.compare_digest(key.encode(), token.encode()):
+                        user = get_user_model().objects.filter(username=username, is_active=True).first()
+                        if user:
+                            request.user = user
+                            set_credential(authorization, user)
+                            return True
             return False
         else:
             return False
     return True
 
 
-def dispatcher(request, path):
+def dispatcher(request, path, dashboards=None):
     allowed_attrs = []
     extra_attrs = []
     instance = None
@@ -236,36 +278,31 @@ def dispatcher(request, path):
     queryset = None
     tokens = [token for token in path.split('/') if '=' not in token]
     token = tokens.pop(0)
-    installed_apps = [label.split('.')[-1] for label in settings.INSTALLED_APPS]
-    api_app_models = [cls.metaclass().model_name for cls in  apps.get_models() if cls.metaclass().app_label == 'api']
     if token == 'dashboard':
-        obj = Dashboards(request).main()
-        if tokens:
-            token = tokens.pop(0)
-            if token in installed_apps or token in api_app_models:
-                if token in installed_apps:
-                    app_label, model_name = token, tokens.pop(0)
-                else:
-                    app_label, model_name = 'api', token
-                obj = apps.get_model(app_label, model_name).objects.view()
-                if isinstance(obj, QuerySet):
-                    queryset = obj
-                    obj = obj.default_actions().expand().admin()
-                allowed_attrs = obj.get_allowed_attrs()
-                if tokens:
-                    if len(tokens) == 1 and tokens[0].isdigit():
-                        if request.method.lower() == 'put':
-                            tokens.append('edit')
-                        elif request.method.lower() == 'delete':
-                            tokens.append('delete')
-                else:
-                    if request.method.lower() == 'post':
-                        tokens.append('add')
+        model = routes.resolve(tokens) if tokens else None
+        if model is not None:
+            obj = routes.get_queryset(model)
+            if isinstance(obj, QuerySet):
+                queryset = obj
+            allowed_attrs = routes.get_allowed_attrs(model)
+            if tokens:
+                if len(tokens) == 1 and tokens[0].isdigit():
+                    if request.method.lower() == 'put':
+                        tokens.append('edit')
                     elif request.method.lower() == 'delete':
                         tokens.append('delete')
-                    if not obj.has_permission(request.user):
-                        raise PermissionDenied()
             else:
+                if request.method.lower() == 'post':
+                    tokens.append('add')
+                elif request.method.lower() == 'delete':
+                    tokens.append('delete')
+                if not obj.has_permission(request.user):
+                    raise PermissionDenied()
+        else:
+            # the dashboards are only built when the path does not refer to a model
+            obj = (dashboards or Dashboards(request)).main()
+            if tokens:
+                token = tokens.pop(0)
                 allowed_attrs = obj.view().get_allowed_attrs()
                 if token in ACTIONS:
                     tokens.append(token)
@@ -277,16 +314,16 @@ def dispatcher(request, path):
                         obj = obj.attr(token, source=True)
                 else:
                     raise  PermissionDenied()
-        else:
-            obj = obj.view()
-            allowed_attrs = obj.get_allowed_attrs()
-            if not request.user.is_authenticated:
-                raise PermissionDenied()
+            else:
+                obj = obj.view()
+                allowed_attrs = obj.get_allowed_attrs()
+                if not request.user.is_authenticated:
+                    raise PermissionDenied()
     else:
         raise PermissionDenied()
     for i, token in enumerate(tokens):
         if i == 0:
-            allowed_attrs.extend(EXPOSE)
+            allowed_attrs = set(allowed_attrs).union(EXPOSE)
         if not request.user.is_authenticated and token not in allowed_attrs and token not in extra_attrs and not token.isdigit() and '-' not in token:
             # print(token, type(obj).__name__, allowed_attrs, extra_attrs)
             raise PermissionDenied()
@@ -354,4 +391,6 @@ def dispatcher(request, path):
         obj = obj.contextualize(request).apply_role_lookups(request.user)
     if request.path.startswith('/api/') and isinstance(obj, QuerySet):
         obj = obj.process_request(request)
+    elif request.path.startswith('/meta/') and isinstance(obj, QuerySet):
+        obj = obj.process_cursor(request)
     return obj
@@ -63,6 +63,7 @@ if os.environ.get('REDIS_HOST'):
     REDIS_PASSWORD = os.environ.get('REDIS_PASSWORD', None)
     SESSION_ENGINE = 'django.contrib.sessions.backends.cache'
     SESSION_CACHE_ALIAS = 'default'
+    COUNT_CACHE_TIMEOUT = 300
     CACHES = {
         "default": {
             "BACKEND": "django_redis.cache.RedisCache",
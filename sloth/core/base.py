@@ -50,8 +50,8 @@ class ModelMixin(object):
         return user.is_superuser or self.has_permission(user) or self.is_autouser(user)
 
     def has_attr_permission(self, user, name):
-        attr = getattr(self, 'has_{}_permission'.format(name), None)
-        return attr is None or bool(attr(user))
+        hook = self.get_permission_hooks().get(name)
+        return hook is None or bool(getattr(self, hook)(user))
 
     def has_view_attr_permission(self, user, name):
         has_permission = False
@@ -59,11 +59,21 @@ class ModelMixin(object):
             has_permission = True
         if self.is_view_attr(name) and self.has_view_permission(user):
             has_permission = True
-        attr = getattr(self, 'has_{}_permission'.format(name), None)
-        return attr(user) if attr else has_permission
+        hook = self.get_permission_hooks().get(name)
+        return getattr(self, hook)(user) if hook else has_permission
+
+    @classmethod
+    @lru_cache
+    def get_permission_hooks(cls):
+        # maps the names of the attributes to their has_<name>_permission methods, so that only existing hooks are called
+        return {
+            name[4:-11]: name for name in dir(cls)
+            if name.startswith('has_') and name.endswith('_permission') and callable(getattr(cls, name, None))
+        }
 
     def is_view_attr(self, name):
-        if not hasattr(self.__class__, '__view__'):
+        # the attributes of view() are collected once per class (subclasses do not share their parent's ones)
+        if '__view__' not in self.__class__.__dict__:
             attr_names = []
 
             def append_attr_names(valueset):
@@ -80,8 +90,8 @@ class ModelMixin(object):
                             if isinstance(attr, ValueSet):
                                 append_attr_names(attr)
             append_attr_names(self.view())
-            setattr(self.__class__, '__view__', attr_names)
-        return name in getattr(self.__class__, '__view__')
+            setattr(self.__class__, '__view__', frozenset(attr_names))
+        return name in self.__class__.__dict__['__view__']
 
     def has_add_permission(self, user):
         return user.is_superuser or self.has_permission(user) or (hasattr(self, 'autouser') and self.is_autouser(user))
@@ -320,6 +330,43 @@ class ModelMixin(object):
                     pass
         return None
 
+    @classmethod
+    @lru_cache
+    def get_lookup_plan(cls, lookup):
+        # classifies a display lookup as "field", "related" (fk traversal), "many" (m2m or reverse fk)
+        # or "method" and returns the relation path that must be joined or prefetched to resolve it
+        model = cls
+        kind = 'field'
+        path = []
+        for attr_name in lookup.split('__'):
+            try:
+                field = model.metaclass().get_field(attr_name)
+            except FieldDoesNotExist:
+                return ('method' if not path else kind), '__'.join(path)
+            if not field.is_relation:
+                break
+            path.append(attr_name)
+            if field.many_to_many or field.one_to_many or field.related_model is None:
+                kind = 'many'
+                break
+            kind = 'related'
+            model = field.related_model
+        return kind, '__'.join(path)
+
+    @classmethod
+    @lru_cache
+    def get_str_lookups(cls, depth=2):
+        # foreign keys that the __str__ of the model may traverse (e.g. "municipio__estado" for an address), which
+        # are joined when its objects are displayed in a column of another model
+        paths = []
+        if depth:
+            for field in cls.metaclass().fields:
+                if field.is_relation and (field.many_to_one or field.one_to_one) and field.related_model:
+                    paths.append(field.name)
+                    for path in field.related_model.get_str_lookups(depth - 1):
+                        paths.append('{}__{}'.format(field.name, path))
+        return tuple(paths)
+
     @classmethod
     def default_list_fields(cls):
         list_display = getattr(cls.metaclass(), 'list_display', None)
@@ -0,0 +1,509 @@
+# -*- coding: utf-8 -*-
+
+import re
+import hmac
+import time
+import hashlib
+import threading
+from datetime import datetime
+from collections import OrderedDict
+from functools import partial, wraps
+from contextlib import ExitStack, contextmanager
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import cache
+from django.core import checks
+from django.core.exceptions import EmptyResultSet
+from django.db import connections, transaction
+from django.contrib.messages import get_messages
+from django.db.models import signals
+from django.db.models.deletion import Collector
+from django.dispatch import Signal
+from sloth.utils.http import StreamingApiResponse
+from oauth2_provider.settings import oauth2_settings
+
+VERSION_KEY = 'sloth:version:{}'
+COUNT_KEY = 'sloth:count:{}'
+ATTR_KEY = 'sloth:attr:{}'
+ETAG_KEY = 'sloth:etag:{}'
+FRAGMENT_KEY = 'sloth:fragment:{}'
+SKELETON_KEY = 'sloth:skeleton:{}'
+CREDENTIAL_KEY = 'sloth:credential:{}'
+RECORDER = threading.local()
+# sent once the changes to the tables are committed
+tables_changed = Signal()
+
+
+class LocalCache(object):
+    # bounded in-process cache that evicts the least recently used entries
+
+    def __init__(self, size):
+        self.size = size
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.data.get(key)
+            if value is not None:
+                self.data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.data[key] = value
+            self.data.move_to_end(key)
+            while len(self.data) > self.size:
+                self.data.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+
+def get_tables(query):
+    # tables read by the query, including the ones referenced by subqueries in filters and annotations
+    tables = set()
+    queries = [query]
+    while queries:
+        query = queries.pop()
+        tables.update(join.table_name for join in query.alias_map.values())
+        queries.extend(getattr(query, 'combined_queries', ()))
+        expressions = [query.where, *query.annotations.values()]
+        while expressions:
+            expression = expressions.pop()
+            if hasattr(expression, 'alias_map'):
+                queries.append(expression)
+            elif hasattr(getattr(expression, 'query', None), 'alias_map'):
+                queries.append(expression.query)
+            elif hasattr(expression, 'children'):
+                expressions.extend(expression.children)
+            elif hasattr(expression, 'get_source_expressions'):
+                expressions.extend(item for item in expression.get_source_expressions() if item is not None)
+    return tables
+
+
+def get_versions(tables):
+    keys = [VERSION_KEY.format(table) for table in sorted(tables)]
+    versions = cache.get_many(keys)
+    missing = {key: time.time_ns() for key in keys if key not in versions}
+    if missing:
+        cache.set_many(missing, None)
+        versions.update(missing)
+    return [versions[key] for key in keys]
+
+
+def increment(tables, committed=False):
+    for table in tables:
+        key = VERSION_KEY.format(table)
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, time.time_ns(), None)
+    if committed:
+        tables_changed.send(sender=None, tables=tables)
+
+
+def touch(*tables, using=None):
+    # inside a transaction the versions are bumped right away, so that it does not read its own stale values, and
+    # again once it is committed, discarding what other connections cached from the previous state in between
+    if transaction.get_connection(using).in_atomic_block:
+        increment(tables)
+        transaction.on_commit(partial(increment, tables, committed=True), using=using)
+    else:
+        increment(tables, committed=True)
+
+
+def touch_model(model, using=None):
+    touch(model._meta.db_table, *[parent._meta.db_table for parent in model._meta.get_parent_list()], using=using)
+
+
+def estimated_count(qs):
+    # pg_class.reltuples is only meaningful for unfiltered single-table querysets
+    threshold = getattr(settings, 'COUNT_ESTIMATE_THRESHOLD', None)
+    connection = connections[qs.db]
+    if threshold is None or connection.vendor != 'postgresql':
+        return None
+    query = qs.query
+    if query.where or query.distinct or query.is_sliced or query.combine or len(query.alias_map) > 1:
+        return None
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT reltuples FROM pg_class WHERE relname = %s', [qs.model._meta.db_table])
+        row = cursor.fetchone()
+    if row and row[0] >= threshold:
+        return int(row[0])
+    return None
+
+
+def get_cache_key(qs, prefix='count'):
+    sql, params = qs.query.get_compiler(qs.db).as_sql()
+    versions = get_versions(get_tables(qs.query))
+    return COUNT_KEY.format('{}:{}'.format(prefix, hashlib.md5('{}{}{}{}'.format(qs.db, sql, params, versions).encode()).hexdigest()))
+
+
+def cached_count(qs, func):
+    timeout = getattr(settings, 'COUNT_CACHE_TIMEOUT', 0)
+    if qs._result_cache is not None:
+        return func()
+    total = estimated_count(qs)
+    if total is not None:
+        record_tables(get_tables(qs.query))
+        return total
+    if not timeout:
+        return func()
+    try:
+        key = get_cache_key(qs)
+    except EmptyResultSet:
+        return 0
+    total = cache.get(key)
+    if total is None:
+        total = func()
+        cache.set(key, total, timeout)
+    else:
+        record_tables(get_tables(qs.query))
+    return total
+
+
+def cached_counts(querysets):
+    # counts of several querysets computed in a single query (UNION ALL of their counts) and cached as the ones of
+    # cached_count, so that the key of each count only changes when its lookups or its tables change
+    timeout = getattr(settings, 'COUNT_CACHE_TIMEOUT', 0)
+    totals, keys, pending = [estimated_count(qs) for qs in querysets], {}, {}
+    if querysets:
+        record_tables(set().union(*[get_tables(qs.query) for qs in querysets]))
+    for i, qs in enumerate(querysets):
+        if totals[i] is None and timeout:
+            try:
+                keys[i] = get_cache_key(qs)
+            except EmptyResultSet:
+                totals[i] = 0
+    cached = cache.get_many(keys.values()) if keys else {}
+    for i, key in keys.items():
+        totals[i] = cached.get(key, totals[i])
+    for i, qs in enumerate(querysets):
+        if totals[i] is None:
+            query = qs.order_by().query.clone()
+            query.select_related = False
+            try:
+                sql, params = query.get_compiler(qs.db).as_sql()
+            except EmptyResultSet:
+                totals[i] = 0
+                continue
+            pending.setdefault(qs.db, []).append(('SELECT {0}, COUNT(*) FROM ({1}) count{0}'.format(i, sql), params))
+    for db, selects in pending.items():
+        with connections[db].cursor() as cursor:
+            cursor.execute(' UNION ALL '.join(sql for sql, _ in selects), [p for _, params in selects for p in params])
+            for i, total in cursor.fetchall():
+                totals[i] = total
+    if keys:
+        cache.set_many({key: totals[i] for i, key in keys.items() if key not in cached}, timeout)
+    return totals
+
+
+def cached_aggregate(qs, **aggregates):
+    timeout = getattr(settings, 'COUNT_CACHE_TIMEOUT', 0)
+    if not timeout:
+        return qs.aggregate(**aggregates)
+    # the annotated query is only compiled to build a key holding every aggregate condition
+    key = get_cache_key(qs.annotate(**aggregates), prefix='aggregate')
+    result = cache.get(key)
+    if result is None:
+        result = qs.aggregate(**aggregates)
+        cache.set(key, result, timeout)
+    else:
+        record_tables(get_tables(qs.query))
+    return result
+
+
+def get_attr_tables(attr):
+    tables = set()
+    for model in getattr(attr, '__depends__', ()):
+        model = apps.get_model(model) if isinstance(model, str) else model
+        tables.update([model._meta.db_table, *[parent._meta.db_table for parent in model._meta.get_parent_list()]])
+    return tables
+
+
+def get_attr_owner(attr, user):
+    from sloth.api.models import RoleContext
+    scope = getattr(attr, '__cache_scope__', 'user')
+    if scope == 'global':
+        return scope
+    elif scope == 'role':
+        return user.is_superuser, sorted(RoleContext.get(user).names)
+    elif scope == 'scope':
+        return user.is_superuser, RoleContext.get(user).roles
+    return user.id
+
+
+def get_attr_cache_key(attr, request, path):
+    # attributes decorated with @meta(cache=N) are shared by everybody ("global"), by users with the same roles
+    # ("role"), by users with the same roles and scopes ("scope") or kept per user ("user"), and the versions of
+    # the tables of the models they depend on make the key change as soon as their data changes
+    scope = getattr(attr, '__cache_scope__', 'user')
+    owner = get_attr_owner(attr, request.user)
+    tables = get_attr_tables(attr)
+    versions = get_versions(tables) if tables else []
+    return ATTR_KEY.format(hashlib.md5('{}{}{}{}'.format(scope, owner, path, versions).encode()).hexdigest())
+
+
+def get_stale(key):
+    # an expired value is still served while the request that acquires the lock recomputes it
+    entry = cache.get(key)
+    if entry is None:
+        return None
+    if entry['expires'] > time.time() or not cache.add('{}:lock'.format(key), 1, 60):
+        return entry['value']
+    return None
+
+
+def get_fresh(key, margin=0):
+    # used by the warmer, which recomputes values that are about to expire
+    entry = cache.get(key)
+    if entry is None or entry['expires'] - margin <= time.time():
+        return None
+    return entry['value']
+
+
+def set_stale(key, value, timeout):
+    stale = getattr(settings, 'CACHE_STALE_TIMEOUT', timeout)
+    cache.set(key, dict(value=value, expires=time.time() + timeout), timeout + stale)
+    cache.delete('{}:lock'.format(key))
+
+
+class TableRecorder(object):
+    # collects the tables read by the queries executed while recording and whether any statement changed data
+
+    PATTERN = re.compile(r'(?:FROM|JOIN)\s+[`"]?(\w+)[`"]?', re.IGNORECASE)
+    STATEMENTS = 'SELECT', 'WITH', 'SAVEPOINT', 'RELEASE', 'ROLLBACK'
+
+    def __init__(self):
+        self.tables = set()
+        self.writes = False
+        # set when a value whose tables are unknown is served from a cache
+        self.volatile = False
+        self.ignore = {'django_session'} | {
+            item['LOCATION'] for item in settings.CACHES.values() if item['BACKEND'].endswith('DatabaseCache')
+        }
+
+    def __call__(self, execute, sql, params, many, context):
+        tables = set(self.PATTERN.findall(sql)) - self.ignore
+        if sql.lstrip().split(None, 1)[0].upper() not in self.STATEMENTS and tables:
+            self.writes = True
+        self.tables.update(tables)
+        return execute(sql, params, many, context)
+
+    @classmethod
+    def current(cls):
+        return getattr(RECORDER, 'value', None)
+
+    @contextmanager
+    def record(self):
+        # connections are thread local, so threads started while recording must record as well
+        previous = self.current()
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(self))
+            RECORDER.value = self
+            try:
+                yield self
+            finally:
+                RECORDER.value = previous
+
+
+def record_tables(tables):
+    # values served from the caches run no queries, so the tables they depend on are recorded explicitly
+    recorder = TableRecorder.current()
+    if recorder:
+        if tables:
+            recorder.tables.update(tables)
+        else:
+            recorder.volatile = True
+
+
+def get_etag(request, tables):
+    session = getattr(request, 'session', None)
+    versions = get_versions(set(tables) | {request.user._meta.db_table})
+    return hashlib.md5('{}{}{}{}{}{}'.format(
+        request.user.pk, request.get_full_path(), StreamingApiResponse.get_format(request),
+        session.get('session_lookups') if session else None, sorted(tables), versions
+    ).encode()).hexdigest()
+
+
+def get_etag_key(request):
+    # the same url is represented as json or streamed (e.g. "Accept: application/x-ndjson")
+    return ETAG_KEY.format(hashlib.md5('{}{}{}'.format(
+        request.user.pk, request.get_full_path(), StreamingApiResponse.get_format(request)
+    ).encode()).hexdigest())
+
+
+def get_cached_etag(request):
+    # the etag of the last response is rebuilt from the tables it read without executing the view again
+    tables = cache.get(get_etag_key(request))
+    return None if tables is None else get_etag(request, tables)
+
+
+def set_cached_etag(request, recorder):
+    if recorder.writes or recorder.volatile:
+        return None
+    cache.set(get_etag_key(request), sorted(recorder.tables), getattr(settings, 'ETAG_CACHE_TIMEOUT', 86400))
+    return get_etag(request, recorder.tables)
+
+
+def get_fragment_key(request, *identifiers):
+    from sloth.api.models import RoleContext
+    user = request.user
+    if getattr(settings, 'FRAGMENT_CACHE_SCOPE', 'user') == 'role':
+        # the scopes of the roles are part of the owner, since the querysets are filtered by them
+        owner = user.is_superuser, RoleContext.get(user).roles
+    else:
+        owner = user.id
+    session = getattr(request, 'session', None)
+    return FRAGMENT_KEY.format(hashlib.md5('{}{}{}{}{}'.format(
+        owner, request.get_full_path(), request.headers.get('x-requested-with'),
+        session.get('session_lookups') if session else None, identifiers
+    ).encode()).hexdigest())
+
+
+def get_skeleton_key(request, mobile=False):
+    # the static parts of the dashboards only depend on the roles of the user, the selected app and the device, and
+    # are discarded when the roles are changed or the application is deployed again (DEPLOY_TOKEN, which must be shared
+    # by all the processes of a deployment)
+    from sloth.api.models import Role, RoleContext
+    user = request.user
+    return SKELETON_KEY.format(hashlib.md5('{}{}{}{}{}{}{}'.format(
+        user.is_superuser, sorted(RoleContext.get(user).names), request.session.get('app_name'), mobile,
+        request.path.startswith('/app/'), get_versions([Role._meta.db_table]), settings.DEPLOY_TOKEN
+    ).encode()).hexdigest())
+
+
+@checks.register(checks.Tags.caches)
+def check_deploy_token(app_configs, **kwargs):
+    # the skeletons are shared by all the processes of a deployment, which therefore must use the same DEPLOY_TOKEN
+    if getattr(settings, 'DASHBOARD_CACHE_TIMEOUT', 0) and not getattr(settings, 'DEPLOY_TOKEN', None):
+        return [checks.Error('DEPLOY_TOKEN must be set when DASHBOARD_CACHE_TIMEOUT is enabled.', id='sloth.E001')]
+    return []
+
+
+def has_csrf_token(request, html):
+    # fragments containing forms embed the csrf token of the user, which can not be shared nor reused after login
+    token = request.META.get('CSRF_COOKIE')
+    return 'csrfmiddlewaretoken' in html or bool(token and token in html)
+
+
+def cached_fragment(func):
+    # keeps the html of value sets and querysets (FRAGMENT_CACHE_TIMEOUT) while the tables read to render it are
+    # unchanged, so that changes to any model involved in the fragment invalidate it
+    @wraps(func)
+    def wrapper(self, path=None, print=False):
+        request = self.request
+        timeout = getattr(settings, 'FRAGMENT_CACHE_TIMEOUT', 0)
+        if not timeout or request is None or request.method != 'GET' or not request.user.is_authenticated:
+            return func(self, path=path, print=print)
+        if len(get_messages(request)):
+            return func(self, path=path, print=print)
+        try:
+            key = get_fragment_key(request, path, print, *self.get_fragment_identifiers())
+        except EmptyResultSet:
+            return func(self, path=path, print=print)
+        entry = cache.get(key)
+        if entry and get_versions(entry['tables']) == entry['versions']:
+            record_tables(entry['tables'])
+            return entry['html']
+        recorder = TableRecorder()
+        with recorder.record():
+            html = func(self, path=path, print=print)
+        if not recorder.writes and not has_csrf_token(request, html):
+            entry = dict(tables=sorted(recorder.tables), versions=get_versions(recorder.tables), html=html)
+            cache.set(key, entry, timeout)
+        return html
+    return wrapper
+
+
+CREDENTIALS = LocalCache(getattr(settings, 'CREDENTIAL_CACHE_SIZE', 256))
+
+
+def get_credential_key(authorization):
+    # keyed hash of the authorization header, so that neither passwords nor tokens are kept in the cache
+    return CREDENTIAL_KEY.format(hmac.new(
+        settings.SECRET_KEY.encode(), authorization.encode(), hashlib.sha256
+    ).hexdigest())
+
+
+def get_credential(authorization):
+    # user and access token of a header verified less than CREDENTIAL_CACHE_TIMEOUT seconds ago whose user has not
+    # changed (e.g. the password) and whose tokens have not been changed or removed since then; the shared cache only
+    # keeps their pks, which are fetched again, while the users of api keys are kept in the memory of the process
+    from django.contrib.auth import get_user_model
+    from oauth2_provider.models import get_access_token_model
+    if not getattr(settings, 'CREDENTIAL_CACHE_TIMEOUT', 0):
+        return None
+    key = get_credential_key(authorization)
+    entry = CREDENTIALS.get(key) if authorization.startswith('ApiKey ') else cache.get(key)
+    if entry is None or entry['expires'] <= time.time() or get_versions([entry['owner']]) != entry['versions']:
+        return None
+    if 'user' in entry:
+        return entry['user'], None
+    if entry['access_token_id']:
+        access_token = get_access_token_model().objects.select_related('user').filter(
+            pk=entry['access_token_id'], expires__gt=datetime.now()
+        ).first()
+        return (access_token.user, access_token) if access_token else None
+    user = get_user_model().objects.filter(pk=entry['user_id'], is_active=True).first()
+    return (user, None) if user else None
+
+
+def set_credential(authorization, user, access_token=None):
+    timeout = getattr(settings, 'CREDENTIAL_CACHE_TIMEOUT', 0)
+    if timeout:
+        owner = 'credential:{}'.format(user.pk)
+        entry = dict(owner=owner, versions=get_versions([owner]), expires=time.time() + timeout)
+        if authorization.startswith('ApiKey '):
+            CREDENTIALS.set(get_credential_key(authorization), dict(entry, user=user))
+        else:
+            entry.update(user_id=user.pk, access_token_id=access_token.pk if access_token else None)
+            cache.set(get_credential_key(authorization), entry, timeout)
+
+
+def revoke_credentials(sender, instance, update_fields=None, **kwargs):
+    from django.contrib.auth.base_user import AbstractBaseUser
+    from oauth2_provider.models import AbstractAccessToken
+    if isinstance(instance, AbstractBaseUser):
+        # logins only change the last_login field
+        if update_fields is None or set(update_fields) != {'last_login'}:
+            touch('credential:{}'.format(instance.pk))
+    elif isinstance(instance, AbstractAccessToken) and instance.user_id:
+        touch('credential:{}'.format(instance.user_id))
+
+
+def post_save(sender, using=None, **kwargs):
+    touch_model(sender, using=using)
+
+
+def m2m_changed(sender, action, using=None, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        touch_model(sender, using=using)
+
+
+def collector_delete(delete):
+    # receivers of post_delete would prevent the fast deletes of every model, so the tables of the deleted (or
+    # updated by SET_NULL and alike) objects are touched by the collector used by Model.delete and QuerySet.delete
+    @wraps(delete)
+    def wrapper(self):
+        models = {*self.data, *self.field_updates, *(qs.model for qs in self.fast_deletes)}
+        result = delete(self)
+        for model in models:
+            touch_model(model, using=self.using)
+        return result
+    return wrapper
+
+
+Collector.delete = collector_delete(Collector.delete)
+signals.post_save.connect(post_save, dispatch_uid='sloth_cache_post_save')
+signals.m2m_changed.connect(m2m_changed, dispatch_uid='sloth_cache_m2m_changed')
+signals.post_save.connect(revoke_credentials, dispatch_uid='sloth_credentials_post_save')
+signals.post_delete.connect(
+    revoke_credentials, sender=settings.AUTH_USER_MODEL, dispatch_uid='sloth_credentials_user_post_delete'
+)
+signals.post_delete.connect(
+    revoke_credentials, sender=oauth2_settings.ACCESS_TOKEN_MODEL, dispatch_uid='sloth_credentials_token_post_delete'
+)
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 
+import copy
 import datetime
 import json
 import math
@@ -11,18 +12,28 @@ import pickle
 import base64
 from django.core import signing
 from django.conf import settings
+from django.core.exceptions import EmptyResultSet
 from django.contrib import messages
 from django.db import models
-from django.db.models import Q
+from django.db.models import F, Q
 from django.db.models.aggregates import Sum, Count
 from django.template.loader import render_to_string
 from django.apps import apps
 
 from sloth.utils.http import XlsResponse, CsvResponse
 from sloth.core.statistics import QuerySetStatistics
+from sloth.core.search import get_search_backend
+from sloth.core.cache import LocalCache, cached_count, cached_aggregate, cached_fragment, touch_model
+from sloth.core.rollup import invalidate as invalidate_rollups
 from sloth.api.exceptions import JsonReadyResponseException, HtmlReadyResponseException, ReadyResponseException
 from sloth.utils import getattrr, serialize, pretty, to_snake_case
 
+SHELL_METADATA = (
+    'uuid', 'attr', 'verbose_name', 'display', 'ignore', 'search', 'filters', 'ordering', 'calendar', 'view',
+    'actions', 'global_actions', 'batch_actions', 'inline_actions', 'related_field', 'template'
+)
+SHELLS = LocalCache(getattr(settings, 'QUERYSET_SHELL_CACHE_SIZE', 256) or 1)
+
 
 class QuerySet(models.QuerySet):
 
@@ -39,7 +50,8 @@ class QuerySet(models.QuerySet):
             page=1, limit=20, interval='', total=0, ignore=[], only={}, is_admin=False, ordering=[],
             actions=[], attach=[], template=None, attr=None, source=None, aggregations=[], calendar=None,
             global_actions=[], batch_actions=[], inline_actions=[], lookups=[], collapsed=True, compact=False,
-            verbose_name=None, related_field=None, scrollable=False, tree=None, session_lookups=[], on_demand=False
+            verbose_name=None, related_field=None, scrollable=False, tree=None, session_lookups=[], on_demand=False,
+            keyset=False, cursor=None, cursors={}, uncounted=False, has_next=False
         )
         if self.model and getattr(self.model.metaclass(), 'autouser', False):
             self.lookups(autouser='pk')
@@ -126,26 +138,27 @@ class QuerySet(models.QuerySet):
         return allowed
 
     def apply_role_lookups(self, user, session=None):
+        from sloth.api.models import RoleContext
         qs = None
         if user.is_superuser:
             return self
-        else:
-            for field_name, role_names in self.metadata['only'].items():
-                if not self.request.user.roles.contains(*role_names):
-                    self.ignore(field_name)
+        roles = RoleContext.get(user)
+        for field_name, role_names in self.metadata['only'].items():
+            if not roles.contains(*role_names):
+                self.ignore(field_name)
         if self.metadata['lookups']:
             lookups = []
             for name, scopes in self.metadata['lookups']:
                 if scopes:
-                    if user.roles.contains(name):
+                    if roles.contains(name):
                         for scope_value_attr, scope_key in scopes.items():
                             if scope_key == 'username':
                                 lookups.append(Q(**{scope_value_attr: user.username}))
                             else:
-                                for scope_value in user.roles.filter(active=True, name=name, scope_key=scope_key).values_list('scope_value', flat=True):
+                                for scope_value in roles.get_scope_values(name, scope_key):
                                     lookups.append(Q(**{scope_value_attr: scope_value}))
                 else:
-                    if user.roles.contains(name):
+                    if roles.contains(name):
                         lookups = None
                         break
             if lookups is None:
@@ -155,7 +168,7 @@ class QuerySet(models.QuerySet):
         if session and self.metadata['session_lookups']:
             lookups = []
             for name, scopes in self.metadata['session_lookups']:
-                if user.roles.contains(name):
+                if roles.contains(name):
                     for k, v in scopes.items():
                         if v in session['session_lookups'] and session['session_lookups'][v]['value']:
                             lookups.append(Q(**{k: session['session_lookups'][v]['value']}))
@@ -244,36 +257,28 @@ class QuerySet(models.QuerySet):
                     hidden = lookup == self.metadata['calendar']
                     formfield = field.formfield(label=n, required=False)
                     fkey = '{}__{}'.format(lookup, sublookup)
-                    filters[k] = dict(key=fkey, name=n, type=filter_type, choices=None, hidden=hidden, value=self.request.GET.get(fkey) if self.request else None)
+                    filters[k] = dict(key=fkey, name=n, type=filter_type, choices=None, hidden=hidden, value=None)
                     filters[k].update(formfield=formfield) if as_form else None
             elif filter_type == 'choices':
-                value = None
-                if self.request and self.request.GET.get(lookup):
-                    value = [self.request.GET.get(f'{lookup}0'), self.request.GET.get(lookup)]
-                filters[key] = dict(key=lookup, name=name, type=filter_type, choices=None, hidden=False, value=value)
+                filters[key] = dict(key=lookup, name=name, type=filter_type, choices=None, hidden=False, value=None)
                 url = '{}?uuid={}&choices={}'.format(path, path.split('/')[-2], lookup) if path else None
                 if url:
                     filters[key].update(source=url)
                 filters[key].update(formfield=formfield) if as_form else None
             else:
                 filters[key] = dict(
-                    key=lookup, name=name, type=filter_type, choices=None, hidden=False, value=self.request.GET.get(lookup) if self.request else None
+                    key=lookup, name=name, type=filter_type, choices=None, hidden=False, value=None
                 )
                 filters[key].update(formfield=formfield) if as_form else None
-            if filter_type == 'boolean':
-                filters[key]['value'] = filters[key]['value'] if filters[key]['value'] else None
 
         ordering = []
         for lookup in self.metadata['ordering']:
             field = self.model.get_field(lookup)
             ordering.append(dict(id=lookup, text=field.verbose_name))
         if ordering:
-            value = None
             key = 'ordering'
-            if self.request and self.request.GET.get(key):
-                value = [self.request.GET.get(f'{key}0'), self.request.GET.get(key)]
             filters[key] = dict(
-                key='ordering', name='Ordenação', type='choices', choices=ordering, value=value
+                key='ordering', name='Ordenação', type='choices', choices=ordering, value=None
             )
             if as_form:
                 choices = [(o['id'], [o['text']]) for o in ordering]
@@ -292,13 +297,24 @@ class QuerySet(models.QuerySet):
 
             return FilterForm
 
+        for item in filters.values():
+            item['value'] = self.get_filter_value(item)
         return filters
 
+    def get_filter_value(self, item):
+        value = self.request.GET.get(item['key']) if self.request else None
+        if item['type'] == 'choices':
+            return [self.request.GET.get('{}0'.format(item['key'])), value] if value else None
+        if item['type'] == 'boolean':
+            return value if value else None
+        return value
+
     def get_attach(self):
         if isinstance(self.metadata['attach'], dict):
             return self.metadata['attach']
         attaches = {}
         if self.metadata['attach'] and not self.query.is_sliced:
+            subsets = {}
             for i, name in enumerate(['all'] + self.metadata['attach']):
                 attr = getattr(self._clone(), name)
                 attach = attr()
@@ -312,16 +328,38 @@ class QuerySet(models.QuerySet):
                 if isinstance(attach, QuerySet):
                     if verbose_name.lower() == 'all':
                         verbose_name = 'Tudo'
+                    subsets[name] = attach
                     attaches[name] = dict(
-                        name=verbose_name, key=name, count=attach.count(), active=name == active
+                        name=verbose_name, key=name, count=None, active=name == active
                     )
                 else:
                     attaches[name] = dict(
                         name=verbose_name, key=name, active=name == active
                     )
+            for name, count in self.count_subsets(subsets).items():
+                attaches[name]['count'] = count
         self.metadata['attach'] = attaches
         return attaches
 
+    def count_subsets(self, subsets):
+        # subsets that only filter the model's own table are counted together as conditional aggregations
+        aggregates = {}
+        counts = {}
+        for name, qs in subsets.items():
+            query = qs.query
+            if qs.model is self.model and qs.db == self.db and len(query.alias_map) <= 1 and not (
+                query.distinct or query.is_sliced or query.combinator or query.annotations or query.extra
+            ) and qs._result_cache is None:
+                aggregates[name] = Count('pk', filter=query.where) if query.where else Count('pk')
+            else:
+                counts[name] = qs.count()
+        if aggregates:
+            try:
+                counts.update(cached_aggregate(models.QuerySet(self.model, using=self.db), **aggregates))
+            except EmptyResultSet:
+                counts.update({name: subsets[name].count() for name in aggregates})
+        return counts
+
     # tree function
 
     def tree_nodes(self):
@@ -427,34 +465,66 @@ class QuerySet(models.QuerySet):
     def list(self):
         return [str(obj) for obj in self]
 
+    def get_row_plan(self, add_id=False):
+        plan = dict(display=self.get_list_display(add_id=add_id), columns={}, select_related=[], prefetch_related=[])
+        for lookup in plan['display']:
+            kind, path = self.model.get_lookup_plan(lookup)
+            plan['columns'][lookup] = kind
+            if kind == 'related':
+                # the column displays the related object itself, so the foreign keys of its __str__ are joined too
+                paths = [path]
+                if path == lookup:
+                    for name in self.model.get_field(path).related_model.get_str_lookups():
+                        paths.append('{}__{}'.format(path, name))
+                plan['select_related'].extend(name for name in paths if name not in plan['select_related'])
+            elif kind == 'many' and path not in [getattr(item, 'prefetch_to', item) for item in plan['prefetch_related']]:
+                # the related objects are read from the prefetched rows (see ValueSet.load_attr) with their foreign keys
+                model = self.model.get_field(path).related_model
+                names = model.get_str_lookups()
+                if names:
+                    path = models.Prefetch(path, queryset=model._default_manager.get_queryset().select_related(*names))
+                plan['prefetch_related'].append(path)
+        return plan
+
+    def apply_row_plan(self, plan):
+        qs = self
+        if self._result_cache is None and self._fields is None:
+            if plan['select_related']:
+                qs = qs.select_related(*plan['select_related'])
+            if plan['prefetch_related']:
+                qs = qs.prefetch_related(*plan['prefetch_related'])
+        return qs
+
     def to_list(self, wrap=False, detail=True):
         data = []
-        for obj in self:
-            add_id = not wrap
-            actions = self.get_obj_actions(obj)
-            if self.request:
-                for view in self.metadata['view']:
-                    if view['name'] == 'self':
-                        has_view_permission = obj.has_view_permission(self.request.user)
-                    else:
-                        has_view_permission = obj.has_view_attr_permission(self.request.user, view['name'])
-                    if has_view_permission:
-                        actions.append(view['name'])
-            item = obj.value_set(*self.get_list_display(add_id=add_id)).contextualize(self.request).load(wrap=False, detail=detail)
+        plan = self.get_row_plan(add_id=not wrap)
+        objs = list(self.apply_row_plan(plan))
+        allowed = self.get_objs_actions(objs)
+        for obj in objs:
+            actions = [name for name, pks in allowed.items() if obj.pk in pks]
+            item = obj.value_set(*plan['display']).contextualize(self.request).load(wrap=False, detail=detail)
             data.append(dict(id=obj.id, description=str(obj), data=item, actions=actions) if wrap else item)
         return data
 
+    def stream(self, chunk_size=2000):
+        # rows are rendered while the database cursor is consumed, so memory does not grow with the result
+        plan = self.get_row_plan(add_id=True)
+        qs = self.apply_row_plan(plan).order_by(*self.get_ordering())
+        for obj in qs.iterator(chunk_size=chunk_size):
+            yield obj.value_set(*plan['display']).contextualize(self.request).load(wrap=False, detail=False)
+
     def export(self, limit=100):
         data = []
         header = []
-        for i, obj in enumerate(self[0:limit]):
+        plan = self.get_row_plan()
+        for i, obj in enumerate(self.apply_row_plan(plan)[0:limit]):
             if i == 0:
-                for attr_name in self.get_list_display():
+                for attr_name in plan['display']:
                     attr, value = getattrr(obj, attr_name)
                     header.append(pretty(self.model.get_attr_metadata(attr_name)[0]).upper())
                 data.append(header)
             row = []
-            values = obj.value_set(*self.get_list_display()).load(wrap=False, detail=False).values()
+            values = obj.value_set(*plan['display']).load(wrap=False, detail=False).values()
             for value in values:
                 if value is None:
                     value = ''
@@ -464,54 +534,148 @@ class QuerySet(models.QuerySet):
             data.append(row)
         return data
 
-    def get_obj_actions(self, obj):
-        actions = []
+    def get_objs_actions(self, objs):
+        # permissions are evaluated once per action for the whole page, see Action.check_fake_permission_bulk
+        allowed = {}
         for form_name in self.metadata['actions']:
             form_cls = self.model.action_form_cls(form_name)
             if form_cls is None:
                 raise BaseException('Action does not exist: {}'.format(form_name))
-            if self.request is None or form_cls.check_fake_permission(
-                    request=self.request, instance=obj, instantiator=self.instantiator
-            ):
-                actions.append(form_cls.get_api_name())
-        return actions
+            allowed[form_cls.get_api_name()] = form_cls.check_fake_permission_bulk(
+                request=self.request, instances=objs, instantiator=self.instantiator
+            )
+        if self.request:
+            for view in self.metadata['view']:
+                if view['name'] == 'self' and hasattr(self.model, 'has_view_permission_bulk'):
+                    pks = self.model.has_view_permission_bulk(self.request.user, objs)
+                    allowed[view['name']] = {getattr(obj, 'pk', obj) for obj in pks}
+                elif view['name'] == 'self':
+                    allowed[view['name']] = {obj.pk for obj in objs if obj.has_view_permission(self.request.user)}
+                else:
+                    allowed[view['name']] = {
+                        obj.pk for obj in objs if obj.has_view_attr_permission(self.request.user, view['name'])
+                    }
+        return allowed
 
-    def serialize(self, path=None, wrap=False, lazy=False):
-        if wrap:
-            if self.metadata['verbose_name']:
-                verbose_name = self.metadata['verbose_name']
-            elif self.metadata['attr']:
-                verbose_name = pretty(self.metadata['attr'])
+    def get_shell_key(self, path=None):
+        if not getattr(settings, 'QUERYSET_SHELL_CACHE_SIZE', 256) or self.metadata['dfilters']:
+            return None
+        from sloth.api.models import RoleContext
+        roles = ()
+        user = self.request.user if self.request else None
+        if user is not None and user.is_authenticated:
+            roles = user.is_superuser, RoleContext.get(user).roles
+        instantiator = self._hints.get('instance', self.instantiator)
+        signature = [(name, self.metadata[name]) for name in SHELL_METADATA]
+        return repr((
+            self.model._meta.label, signature, roles, self.request is None, type(instantiator).__name__,
+            getattr(instantiator, 'pk', None), path, self.get_list_display()
+        ))
+
+    def get_shell(self, path=None):
+        # the parts of the serialized metadata that only depend on the configuration of the queryset and on the
+        # roles of the user are memoized, leaving data, counts and pagination to be computed on each request
+        key = self.get_shell_key(path)
+        shell = SHELLS.get(key) if key else None
+        if shell is None:
+            shell = self.build_shell(path)
+            if key:
+                SHELLS.set(key, shell)
+        shell = copy.deepcopy(shell)
+        for item in shell['filters'].values():
+            item['value'] = self.get_filter_value(item)
+        return shell
+
+    def build_shell(self, path=None):
+        if self.metadata['verbose_name']:
+            verbose_name = self.metadata['verbose_name']
+        elif self.metadata['attr']:
+            verbose_name = pretty(self.metadata['attr'])
+        else:
+            verbose_name = pretty(self.model.metaclass().verbose_name_plural)
+        shell = dict(
+            verbose_name=verbose_name, icon=getattr(self.model.metaclass(), 'icon', None),
+            search=self.get_search(), display=self.get_display(), filters=self.get_filters(path=path),
+            actions=dict(model=[], instance=[], queryset=[], inline=[]), template=None
+        )
+        for view in self.metadata['view']:
+            if view['name'] == 'self':
+                view_suffix = ''
+                view_name = 'Visualizar'
+            else:
+                view_suffix = '{}/'.format(view['name'])
+                view_name = pretty(self.model.get_attr_metadata(view['name'])[0])
+            item = dict(
+                type='view', key=view['name'], name=view_name, submit=view_name, target='instance',
+                method='get', icon=view['icon'], style='primary', ajax=False,
+                modal=view['modal'], path='{}{{id}}/{}'.format((path or '').split('?')[0], view_suffix)
+            )
+            if view_suffix:
+                shell['actions']['instance'].append(item)
             else:
-                verbose_name = pretty(self.model.metaclass().verbose_name_plural)
+                shell['actions']['instance'].insert(0, item)
+
+        for action_type in ('global_actions', 'actions', 'batch_actions', 'inline_actions'):
+            target = dict(global_actions='model', actions='instance', batch_actions='queryset', inline_actions='inline')[action_type]
+            for form_name in self.metadata[action_type]:
+                if form_name == 'view':
+                    continue
+                form_cls = self.model.action_form_cls(form_name)
+                has_permission = self.request is None or form_cls.check_fake_permission(
+                    request=self.request, instance=self.model(), instantiator=self._hints.get('instance', self.instantiator)
+                )
+                if action_type == 'actions' or has_permission:
+                    action = form_cls.get_metadata(path, target)
+                    shell['actions'][action['target']].append(action)
+        if self.metadata['related_field']:
+            form_cls = self.model.relation_form_cls(self.metadata['related_field'])
+            has_permission = self.request is None or form_cls.check_fake_permission(
+                request=self.request, instance=self.model(), instantiator=self._hints.get('instance')
+            )
+            if has_permission:
+                action = form_cls.get_metadata(path, 'model')
+                shell['actions']['model'].append(action)
+        for key in ('model', 'instance', 'queryset', 'inline'):
+            if not shell['actions'][key]:
+                del shell['actions'][key]
+
+        template = self.metadata['template']
+        if template is None:
+            template = getattr(self.model.metaclass(), 'list_template', None)
+        if template:
+            shell['template'] = template if template.endswith('.html') else '{}.html'.format(template)
+        return shell
 
+    def serialize(self, path=None, wrap=False, lazy=False):
+        if wrap:
             for lookup in self.metadata['dfilters']:
                 qs = self.order_by(lookup).values_list(lookup).distinct()[1:2]
                 if not qs and lookup not in self.metadata['ignore']:
                     self.metadata['ignore'].append(lookup)
 
-            total = self.count()
-            icon = getattr(self.model.metaclass(), 'icon', None)
-            search = self.get_search()
-            display = self.get_display()
-            filters = self.get_filters(path=path)
+            total = None if self.metadata['uncounted'] else self.count()
+            shell = self.get_shell(path=path)
             attach = self.get_attach() if self.metadata['attr'] is None else {}
             calendar = self.to_calendar() if self.metadata['calendar'] and not lazy else None
             values = {} if lazy else self.paginate().to_list(wrap=wrap, detail=True)
-            pages = []
-            n_pages = ((total-1) // self.metadata['limit']) + 1
-            for page in range(0, n_pages):
-                if page < 4 or (page > self.metadata['page'] - 3 and page < self.metadata['page'] + 1) or page > n_pages - 5:
-                    pages.append(page + 1)
+            if total is None:
+                n_pages = self.metadata['page'] + (1 if self.metadata['has_next'] else 0)
+            else:
+                n_pages = ((total-1) // self.metadata['limit']) + 1
+                self.metadata['has_next'] = self.metadata['page'] < n_pages
+            pages = [] if self.metadata['keyset'] else self.get_pages(n_pages)
             pagination = dict(
                 interval=self.metadata['interval'],
                 total=total,
                 page=self.metadata['page'],
-                pages=pages
+                pages=pages,
+                has_next=self.metadata['has_next']
             )
+            if self.metadata['keyset']:
+                pagination.update(cursor=self.metadata['cursors'])
             data = dict(
                 uuid=self.metadata['uuid'], type='queryset', path=path,
-                name=verbose_name, key=self.metadata['uuid'], icon=icon, count=n_pages,
+                name=shell['verbose_name'], key=self.metadata['uuid'], icon=shell['icon'], count=n_pages,
                 metadata={}, data=values
             )
             if self.request and self.request.path.startswith('/app/'):
@@ -523,7 +687,8 @@ class QuerySet(models.QuerySet):
                 collapsed = bool(self.request and self.request.GET.get('collapsed', self.metadata['collapsed']) or 0)
                 subset = self.request and self.request.GET.get('subset', 'all') or 'all'
                 data['metadata'].update(
-                    search=search, display=display, filters=filters, actions={}, pagination=pagination,
+                    search=shell['search'], display=shell['display'], filters=shell['filters'],
+                    actions=shell['actions'], pagination=pagination,
                     collapsed=collapsed, subset=subset, on_demand=self.metadata['on_demand'],
                     compact=self.metadata['compact'], is_admin=self.metadata['is_admin']# , state=self.dumps()
                 )
@@ -542,64 +707,13 @@ class QuerySet(models.QuerySet):
                     data['metadata'].update(aggregations=aggregations)
                 if self.metadata['scrollable']:
                     data['metadata'].update(scrollable=True)
-
-                data['metadata']['actions'].update(model=[], instance=[], queryset=[], inline=[])
-
-                for view in self.metadata['view']:
-                    if view['name'] == 'self':
-                        view_suffix = ''
-                        view_name = 'Visualizar'
-                    else:
-                        view_suffix = '{}/'.format(view['name'])
-                        view_name = pretty(self.model.get_attr_metadata(view['name'])[0])
-                    item = dict(
-                        type='view', key=view['name'], name=view_name, submit=view_name, target='instance',
-                        method='get', icon=view['icon'], style='primary', ajax=False,
-                        modal=view['modal'], path='{}{{id}}/{}'.format((path or '').split('?')[0], view_suffix)
-                    )
-                    if view_suffix:
-                        data['metadata']['actions']['instance'].append(item)
-                    else:
-                        data['metadata']['actions']['instance'].insert(0, item)
-
-                for action_type in ('global_actions', 'actions', 'batch_actions', 'inline_actions'):
-                    target = dict(global_actions='model', actions='instance', batch_actions='queryset', inline_actions='inline')[action_type]
-                    for form_name in self.metadata[action_type]:
-                        if form_name == 'view':
-                            continue
-                        form_cls = self.model.action_form_cls(form_name)
-                        has_permission = self.request is None or form_cls.check_fake_permission(
-                            request=self.request, instance=self.model(), instantiator=self._hints.get('instance', self.instantiator)
-                        )
-                        if action_type == 'actions' or has_permission:
-                            action_path = path
-                            if self.request and self.request.GET.get('subset'):
-                                action_path = '{}{}/'.format(path, self.request.GET.get('subset'))
-                            action = form_cls.get_metadata(path, target)
-                            data['metadata']['actions'][action['target']].append(action)
-                if self.metadata['related_field']:
-                    form_cls = self.model.relation_form_cls(self.metadata['related_field'])
-                    has_permission = self.request is None or form_cls.check_fake_permission(
-                        request=self.request, instance=self.model(), instantiator=self._hints.get('instance')
-                    )
-                    if has_permission:
-                        action = form_cls.get_metadata(path, 'model')
-                        data['metadata']['actions']['model'].append(action)
-                if data['metadata']['actions']:
-                    for key in ('model', 'instance', 'queryset', 'inline'):
-                        if not data['metadata']['actions'][key]:
-                            del data['metadata']['actions'][key]
-                else:
-                    del data['metadata']['actions']
-
-                template = self.metadata['template']
-                if template is None:
-                    template = getattr(self.model.metaclass(), 'list_template', None)
-                if template:
-                    template = template if template.endswith('.html') else '{}.html'.format(template)
-                    data.update(template=template)
+                if shell['template']:
+                    data.update(template=shell['template'])
             # from pprint import pprint; pprint(data)
             return data
+        if self.metadata['keyset']:
+            data = self.paginate().to_list(detail=False)
+            return dict(next=self.metadata['cursors']['next'], previous=self.metadata['cursors']['previous'], data=data)
         return self.paginate().to_list(detail=False)
 
     def debug(self):
@@ -654,7 +768,13 @@ class QuerySet(models.QuerySet):
     def search(self, *names, q=None):
         if q is not None:
             lookups = []
-            for search_field in self.metadata['search'] or self.model.default_search_fields():
+            search_fields = self.metadata['search'] or self.model.default_search_fields()
+            backend = get_search_backend(self.model, self.db)
+            if backend and {field.name for field in backend.fields}.issubset(search_fields):
+                # the lookup of the backend includes the substring lookups of the indexed fields
+                lookups.append(backend.lookup(q))
+                search_fields = [name for name in search_fields if name not in [field.name for field in backend.fields]]
+            for search_field in search_fields:
                 lookups.append(Q(**{'{}__icontains'.format(search_field): q}))
             return self.filter(reduce(operator.__or__, lookups))
         else:
@@ -677,6 +797,10 @@ class QuerySet(models.QuerySet):
         self.metadata['limit'] = size
         return self
 
+    def uncounted(self, flag=True):
+        self.metadata['uncounted'] = flag
+        return self
+
     def renderer(self, name):
         self.metadata['template'] = name
         return self
@@ -807,6 +931,116 @@ class QuerySet(models.QuerySet):
         else:
             return self.query.order_by or ['id']
 
+    def keyset(self, cursor=None):
+        self.metadata['keyset'] = True
+        self.metadata['cursor'] = cursor
+        return self
+
+    def get_keyset_ordering(self):
+        ordering = self.get_ordering()
+        if not all(isinstance(lookup, str) and lookup != '?' for lookup in ordering):
+            return None
+        if not [lookup for lookup in ordering if lookup.lstrip('-') in ('pk', 'id')]:
+            ordering = list(ordering) + ['pk']
+        return ordering
+
+    @staticmethod
+    def dumps_cursor(values, previous=False):
+        state = dict(values=values, previous=previous)
+        return signing.dumps(base64.b64encode(zlib.compress(pickle.dumps(state))).decode())
+
+    @staticmethod
+    def loads_cursor(s):
+        # tampered or malformed cursors are ignored, i.e. the first page is returned
+        try:
+            return pickle.loads(zlib.decompress(base64.b64decode(signing.loads(s).encode())))
+        except (signing.BadSignature, ValueError, zlib.error, pickle.UnpicklingError):
+            return None
+
+    @staticmethod
+    def get_keyset_expressions(ordering):
+        # nulls are sorted as if they were greater than any other value whatever the database (as in PostgreSQL)
+        return [
+            F(lookup[1:]).desc(nulls_first=True) if lookup.startswith('-') else F(lookup).asc(nulls_last=True)
+            for lookup in ordering
+        ]
+
+    def seek(self, ordering, values):
+        # rows placed after "values" when sorted by "ordering", i.e (a > x) or (a = x and b > y) or ...
+        lookups = []
+        for i, lookup in enumerate(ordering):
+            name = lookup.lstrip('-')
+            if values[i] is None:
+                if not lookup.startswith('-'):
+                    continue  # nothing is placed after null in ascending order
+                condition = Q(**{'{}__isnull'.format(name): False})
+            elif lookup.startswith('-'):
+                condition = Q(**{'{}__lt'.format(name): values[i]})
+            else:
+                condition = Q(**{'{}__gt'.format(name): values[i]}) | Q(**{'{}__isnull'.format(name): True})
+            for j in range(0, i):
+                previous_name = ordering[j].lstrip('-')
+                if values[j] is None:
+                    condition &= Q(**{'{}__isnull'.format(previous_name): True})
+                else:
+                    condition &= Q(**{previous_name: values[j]})
+            lookups.append(condition)
+        return self.filter(reduce(operator.__or__, lookups)) if lookups else self.none()
+
+    def keyset_paginate(self, qs):
+        ordering = self.get_keyset_ordering()
+        cursor = self.loads_cursor(self.metadata['cursor']) if self.metadata['cursor'] else None
+        if cursor and len(cursor['values']) != len(ordering):
+            cursor = None  # generated for another ordering
+        previous = bool(cursor and cursor['previous'])
+        if previous:
+            seek_ordering = [lookup[1:] if lookup.startswith('-') else '-{}'.format(lookup) for lookup in ordering]
+        else:
+            seek_ordering = ordering
+        if cursor:
+            qs = qs.seek(seek_ordering, cursor['values'])
+        names = [lookup.lstrip('-') for lookup in ordering]
+        rows = list(qs.order_by(*self.get_keyset_expressions(seek_ordering)).values_list(
+            'pk', *names
+        )[0:self.metadata['limit'] + 1])
+        has_more = len(rows) > self.metadata['limit']
+        rows = rows[0:self.metadata['limit']]
+        if previous:
+            rows.reverse()
+        cursors = dict(next=None, previous=None)
+        if rows:
+            if has_more or previous:
+                cursors['next'] = self.dumps_cursor(list(rows[-1][1:]))
+            if cursor and (has_more or not previous):
+                cursors['previous'] = self.dumps_cursor(list(rows[0][1:]), previous=True)
+        self.metadata['cursors'] = cursors
+        self.metadata['has_next'] = cursors['next'] is not None
+        self.metadata['interval'] = 1, len(rows)
+        return self.filter(pk__in=[row[0] for row in rows]).order_by(*self.get_keyset_expressions(ordering))
+
+    def uncounted_paginate(self, qs):
+        # fetches one extra row to know whether there is a next page without counting the whole table
+        ordering = self.get_ordering()
+        start = (self.metadata['page'] - 1) * self.metadata['limit']
+        pks = list(qs.order_by(*ordering).values_list('pk', flat=True)[start:start + self.metadata['limit'] + 1])
+        self.metadata['has_next'] = len(pks) > self.metadata['limit']
+        pks = pks[0:self.metadata['limit']]
+        self.metadata['interval'] = start + 1, start + len(pks)
+        return self.filter(pk__in=pks).order_by(*ordering)
+
+    def get_pages(self, n_pages):
+        # the first four pages, the current page and its neighbours and the last four pages
+        page = self.metadata['page']
+        pages = set(range(1, min(4, n_pages) + 1))
+        pages.update(range(max(1, page - 1), min(page + 1, n_pages) + 1))
+        pages.update(range(max(1, n_pages - 3), n_pages + 1))
+        return sorted(pages)
+
+    def process_cursor(self, request):
+        if 'cursor' in request.GET:
+            self.keyset(request.GET['cursor'] or None)
+        return self
+
     def scrollable(self, flag=True):
         self.metadata['scrollable'] = flag
         return self.datatable()
@@ -825,6 +1059,13 @@ class QuerySet(models.QuerySet):
                 }
                 qs = qs.filter(**lookups)
 
+        if self.metadata['keyset']:
+            if self.get_keyset_ordering():
+                return self.keyset_paginate(qs)
+            # orderings that can not be seeked (e.g. random) only have the first page
+            self.metadata['cursors'] = dict(next=None, previous=None)
+        if self.metadata['uncounted']:
+            return self.uncounted_paginate(qs)
         if self.metadata['page'] != 1:
             start = (self.metadata['page'] - 1) * self.metadata['limit']
             end = start + self.metadata['limit']
@@ -840,6 +1081,11 @@ class QuerySet(models.QuerySet):
 
     # rendering function
 
+    def get_fragment_identifiers(self):
+        signature = [(name, self.metadata[name]) for name in SHELL_METADATA]
+        return self.model._meta.label, str(self.query), signature, self.metadata['source'], self.metadata['page']
+
+    @cached_fragment
     def html(self, path=None, print=False):
         serialized = self.serialize(path=path or self.request.path, wrap=True)
         if self.metadata['source']:
@@ -943,6 +1189,7 @@ class QuerySet(models.QuerySet):
         if 'page' in request.GET:
             page = int(request.GET['page'] or 1)
         if isinstance(attach, QuerySet):
+            qs.process_cursor(request)
             # if request.GET.get('is_admin') and qs.metadata['attr'] is None and request.GET.get('subset') == 'all':
             #     qs.default_actions()
             qs = qs.page(page)
@@ -961,7 +1208,7 @@ class QuerySet(models.QuerySet):
         if x:
             statistcs = QuerySetStatistics(self, x, y=y)
             return statistcs.contextualize(self.request)
-        total = super().count()
+        total = cached_count(self, super().count)
         return total
 
     def sum(self, z, x=None, y=None):
@@ -1041,6 +1288,21 @@ class QuerySet(models.QuerySet):
     def update(self, **kwargs):
         self.__log__('edit', **kwargs)
         super().update(**kwargs)
+        touch_model(self.model, using=self.db)
+        invalidate_rollups(self.model)
+
+    def bulk_create(self, objs, *args, **kwargs):
+        # no signals are sent for the created objects
+        objs = super().bulk_create(objs, *args, **kwargs)
+        touch_model(self.model, using=self.db)
+        invalidate_rollups(self.model)
+        return objs
+
+    def bulk_update(self, objs, *args, **kwargs):
+        rows = super().bulk_update(objs, *args, **kwargs)
+        touch_model(self.model, using=self.db)
+        invalidate_rollups(self.model)
+        return rows
 
     def delete(self):
         kwargs = {f.name: None for f in self.model._meta.fields}
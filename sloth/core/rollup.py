@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+
+import json
+from decimal import Decimal
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models import F, Count, Sum, DateTimeField, TimeField, DurationField, signals
+from django.db.models import query
+from django.db.models.expressions import Col, Expression
+from django.db.models.functions import Extract
+from django.db.models.lookups import Exact
+from sloth.core.cache import touch_model
+
+COUNT = 'count'
+READY = ''
+TRANSFORMS = 'year', 'month'
+# fields whose values are not restored exactly from their json representation (e.g. microseconds are lost)
+INEXACT = DateTimeField, TimeField, DurationField
+
+
+def get_rollups(model):
+    # Meta.rollups lists the groupings maintained for the model (e.g. [('status', 'data__month')]) and
+    # Meta.rollup_sums the numeric fields summed in each one of them besides the number of objects
+    return [tuple(dimensions) for dimensions in getattr(model._meta, 'rollups', None) or ()]
+
+
+def get_aggregates(model):
+    return [COUNT, *(getattr(model._meta, 'rollup_sums', None) or ())]
+
+
+def get_attnames(model):
+    attnames = {model._meta.get_field(name).attname for name in get_aggregates(model)[1:]}
+    for dimensions in get_rollups(model):
+        for dimension in dimensions:
+            attnames.add(model._meta.get_field(dimension.split('__')[0]).attname)
+    return attnames
+
+
+def get_dimension_value(model, dimension, values):
+    tokens = dimension.split('__')
+    value = values[model._meta.get_field(tokens[0]).attname]
+    if value is not None and len(tokens) == 2:
+        value = getattr(value, tokens[1])
+    return value
+
+
+def get_decoder(model, dimension):
+    # the keys are json, so the values are converted back into the types the database returns (e.g. dates)
+    tokens = dimension.split('__')
+    field = model._meta.get_field(tokens[0])
+    if len(tokens) == 2:
+        return int
+    return None if isinstance(field, INEXACT) else field.to_python
+
+
+def get_key(values):
+    return json.dumps(list(values), cls=DjangoJSONEncoder)
+
+
+def get_deltas(model, values, signal):
+    deltas = {}
+    for dimensions in get_rollups(model):
+        key = get_key(get_dimension_value(model, dimension, values) for dimension in dimensions)
+        for aggregate in get_aggregates(model):
+            value = 1 if aggregate == COUNT else values[model._meta.get_field(aggregate).attname] or 0
+            deltas[(','.join(dimensions), aggregate, key)] = Decimal(value) * signal
+    return deltas
+
+
+def get_records():
+    # the rollups are maintained through plain django querysets, which keep this bookkeeping out of the audit log
+    # of sloth's QuerySet (see QuerySet.__log__)
+    from sloth.api.models import Rollup
+    return query.QuerySet(Rollup)
+
+
+def apply(model, deltas):
+    from sloth.api.models import Rollup
+    updated = False
+    for (dimensions, aggregate, key), delta in deltas.items():
+        if delta:
+            lookups = dict(model=model._meta.label, dimensions=dimensions, aggregate=aggregate, key=key)
+            pk = get_records().get_or_create(**lookups)[0].pk
+            get_records().filter(pk=pk).update(value=F('value') + delta)
+            updated = True
+    if updated:
+        touch_model(Rollup)
+
+
+def pre_save(sender, instance, raw=False, **kwargs):
+    if get_rollups(sender) and not raw and instance.pk and not instance._state.adding:
+        instance._rollup_values = sender._default_manager.filter(pk=instance.pk).values(*get_attnames(sender)).first()
+
+
+def post_save(sender, instance, raw=False, **kwargs):
+    if get_rollups(sender) and raw:
+        # fixtures (loaddata) save the objects without their previous values
+        invalidate(sender)
+    elif get_rollups(sender):
+        values = {attname: getattr(instance, attname) for attname in get_attnames(sender)}
+        deltas = get_deltas(sender, values, 1)
+        old = getattr(instance, '_rollup_values', None)
+        if old:
+            for key, delta in get_deltas(sender, old, -1).items():
+                deltas[key] = deltas.get(key, 0) + delta
+            instance._rollup_values = None
+        apply(sender, deltas)
+
+
+def post_delete(sender, instance, **kwargs):
+    if get_rollups(sender):
+        values = {attname: getattr(instance, attname) for attname in get_attnames(sender)}
+        apply(sender, get_deltas(sender, values, -1))
+
+
+def invalidate(model):
+    # changes that do not trigger signals (e.g. QuerySet.update) disable the rollups until they are rebuilt
+    if get_rollups(model):
+        get_records().filter(model=model._meta.label, aggregate=READY).delete()
+
+
+def rebuild(model):
+    from sloth.api.models import Rollup
+    label = model._meta.label
+    with transaction.atomic():
+        get_records().filter(model=label).delete()
+        for dimensions in get_rollups(model):
+            name = ','.join(dimensions)
+            aggregates = {'rollup_{}'.format(aggregate): Sum(aggregate) for aggregate in get_aggregates(model)[1:]}
+            objs = [Rollup(model=label, dimensions=name, aggregate=READY, key='', value=1)]
+            for row in model._default_manager.values(*dimensions).annotate(
+                rollup_count=Count('pk'), **aggregates
+            ).order_by():
+                key = get_key(row[dimension] for dimension in dimensions)
+                for aggregate in get_aggregates(model):
+                    objs.append(Rollup(
+                        model=label, dimensions=name, aggregate=aggregate, key=key,
+                        value=row['rollup_{}'.format(aggregate)] or 0
+                    ))
+            get_records().bulk_create(objs, batch_size=1000)
+        touch_model(Rollup)
+
+
+def get_filters(query):
+    # exact lookups on the model's own columns (optionally extracting the year or the month of dates)
+    filters = {}
+    if query.where.negated or query.where.connector != 'AND' or len(query.alias_map) > 1:
+        return None
+    for lookup in query.where.children:
+        if not isinstance(lookup, Exact) or isinstance(lookup.rhs, Expression):
+            return None
+        lhs, transform = lookup.lhs, None
+        if isinstance(lhs, Extract) and lhs.lookup_name in TRANSFORMS:
+            lhs, transform = lhs.lhs, lhs.lookup_name
+        if not isinstance(lhs, Col):
+            return None
+        name = '{}__{}'.format(lhs.target.name, transform) if transform else lhs.target.name
+        filters[name] = lookup.rhs
+    return filters
+
+
+def aggregate(qs, names, func, z):
+    # rows of the grouped aggregation computed from a rollup containing the grouping and the filtered dimensions
+    from sloth.api.models import Rollup
+    rollups = get_rollups(qs.model)
+    query = qs.query
+    if not rollups or query.distinct or query.is_sliced or query.combinator or query.annotations:
+        return None
+    if func is Count and z in ('id', 'pk'):
+        name = COUNT
+    elif func is Sum and z in get_aggregates(qs.model)[1:]:
+        name = z
+    else:
+        return None
+    filters = get_filters(query)
+    if filters is None:
+        return None
+    for dimensions in rollups:
+        if set(names).union(filters).issubset(dimensions):
+            break
+    else:
+        return None
+    decoders = [get_decoder(qs.model, dimension) for dimension in dimensions]
+    if None in decoders:
+        return None
+    totals, counts, ready = {}, {}, False
+    for row_aggregate, key, total in Rollup.objects.filter(
+        model=qs.model._meta.label, dimensions=','.join(dimensions), aggregate__in=(READY, COUNT, name)
+    ).values_list('aggregate', 'key', 'value'):
+        if row_aggregate == READY:
+            ready = True
+            continue
+        values = {
+            dimension: None if value is None else decode(value)
+            for dimension, decode, value in zip(dimensions, decoders, json.loads(key))
+        }
+        if any(values[dimension] != value for dimension, value in filters.items()):
+            continue
+        group = tuple(values[dimension] for dimension in names)
+        if row_aggregate == COUNT:
+            counts[group] = counts.get(group, 0) + total
+        if row_aggregate == name:
+            totals[group] = totals.get(group, 0) + total
+    if not ready:
+        return None
+    return [
+        (*group, int(total) if name == COUNT else total) for group, total in totals.items() if counts.get(group)
+    ]
+
+
+def class_prepared(sender, **kwargs):
+    # post_delete is only connected to the models with rollups, keeping the fast deletes of the others
+    if get_rollups(sender):
+        signals.post_delete.connect(post_delete, sender=sender, dispatch_uid='sloth_rollup_post_delete')
+
+
+signals.pre_save.connect(pre_save, dispatch_uid='sloth_rollup_pre_save')
+signals.post_save.connect(post_save, dispatch_uid='sloth_rollup_post_save')
+signals.class_prepared.connect(class_prepared, dispatch_uid='sloth_rollup_class_prepared')
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+
+import operator
+from functools import reduce
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+from django.db.models import Q, BooleanField
+from django.db.models.expressions import RawSQL
+from django.utils.module_loading import import_string
+
+TEXT_FIELD_TYPES = 'CharField', 'TextField', 'SlugField'
+EXISTS_KEY = 'sloth:search:{}:{}'
+
+
+class SearchBackend(object):
+    # full-text index over the text columns declared in Meta.search_fields; subclasses implement exists(), create(),
+    # refresh(), drop() and lookup(q), which returns the Q object used by QuerySet.search()
+
+    def __init__(self, model, using='default'):
+        self.model = model
+        self.connection = connections[using]
+        self.table = model._meta.db_table
+        self.fields = []
+        for name in getattr(model.metaclass(), 'search_fields', ()):
+            field = model._meta.get_field(name)
+            if field.concrete and not field.is_relation and field.get_internal_type() in TEXT_FIELD_TYPES:
+                self.fields.append(field)
+
+    def quote(self, name):
+        return self.connection.ops.quote_name(name)
+
+    def execute(self, *statements):
+        with self.connection.cursor() as cursor:
+            for sql in statements:
+                cursor.execute(sql)
+
+    def get_substring_lookups(self, q):
+        return [Q(**{'{}__icontains'.format(field.name): q}) for field in self.fields]
+
+
+class PostgresSearchBackend(SearchBackend):
+    # a tsvector index over all the columns for word matching and one trigram index per column, built on the
+    # same expression django uses for "icontains", so substring lookups are answered by the index as well
+
+    def get_index_name(self, suffix):
+        return '{}_{}'.format(self.table, suffix)[-63:]
+
+    def get_document(self, qualified=False):
+        table = '{}.'.format(self.quote(self.table)) if qualified else ''
+        return " || ' ' || ".join(
+            "coalesce({}{}::text, '')".format(table, self.quote(field.column)) for field in self.fields
+        )
+
+    def exists(self):
+        with self.connection.cursor() as cursor:
+            cursor.execute('SELECT 1 FROM pg_indexes WHERE indexname = %s', [self.get_index_name('search_tsv')])
+            return cursor.fetchone() is not None
+
+    def create(self):
+        statements = ['CREATE EXTENSION IF NOT EXISTS pg_trgm']
+        statements.append("CREATE INDEX IF NOT EXISTS {} ON {} USING gin (to_tsvector('simple', {}))".format(
+            self.quote(self.get_index_name('search_tsv')), self.quote(self.table), self.get_document()
+        ))
+        for field in self.fields:
+            statements.append('CREATE INDEX IF NOT EXISTS {} ON {} USING gin (UPPER({}::text) gin_trgm_ops)'.format(
+                self.quote(self.get_index_name('{}_search_trgm'.format(field.column))),
+                self.quote(self.table), self.quote(field.column)
+            ))
+        self.execute(*statements)
+
+    def refresh(self):
+        self.execute(
+            'REINDEX INDEX {}'.format(self.quote(self.get_index_name('search_tsv'))),
+            'ANALYZE {}'.format(self.quote(self.table))
+        )
+
+    def drop(self):
+        statements = ['DROP INDEX IF EXISTS {}'.format(self.quote(self.get_index_name('search_tsv')))]
+        for field in self.fields:
+            statements.append('DROP INDEX IF EXISTS {}'.format(
+                self.quote(self.get_index_name('{}_search_trgm'.format(field.column)))
+            ))
+        self.execute(*statements)
+
+    def lookup(self, q):
+        condition = RawSQL("to_tsvector('simple', {}) @@ plainto_tsquery('simple', %s)".format(
+            self.get_document(qualified=True)), [q], output_field=BooleanField()
+        )
+        return reduce(operator.__or__, [Q(condition)] + self.get_substring_lookups(q))
+
+
+class SqliteSearchBackend(SearchBackend):
+    # an external content fts5 table kept in sync with the model's table by triggers, whose trigram tokenizer answers
+    # the substring lookups (of at least three characters) without scanning the model's table
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fts = '{}_search'.format(self.table)
+        if self.model._meta.pk.get_internal_type() not in ('AutoField', 'BigAutoField', 'IntegerField'):
+            self.fields = []
+
+    def get_values(self, prefix):
+        return ', '.join(['{}.{}'.format(prefix, self.quote(self.model._meta.pk.column))] + [
+            '{}.{}'.format(prefix, self.quote(field.column)) for field in self.fields
+        ])
+
+    def exists(self):
+        return self.fts in self.connection.introspection.table_names()
+
+    def create(self):
+        columns = ', '.join(self.quote(field.column) for field in self.fields)
+        fts, table = self.quote(self.fts), self.quote(self.table)
+        insert = 'INSERT INTO {}(rowid, {}) VALUES ({});'.format(fts, columns, self.get_values('new'))
+        delete = "INSERT INTO {0}({0}, rowid, {1}) VALUES ('delete', {2});".format(fts, columns, self.get_values('old'))
+        self.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS {} USING fts5({}, content={}, content_rowid={}, "
+            "tokenize='trigram')".format(
+                fts, columns, self.quote(self.table), self.quote(self.model._meta.pk.column)
+            ),
+            'CREATE TRIGGER IF NOT EXISTS {} AFTER INSERT ON {} BEGIN {} END'.format(
+                self.quote('{}_ai'.format(self.fts)), table, insert
+            ),
+            'CREATE TRIGGER IF NOT EXISTS {} AFTER DELETE ON {} BEGIN {} END'.format(
+                self.quote('{}_ad'.format(self.fts)), table, delete
+            ),
+            'CREATE TRIGGER IF NOT EXISTS {} AFTER UPDATE ON {} BEGIN {} {} END'.format(
+                self.quote('{}_au'.format(self.fts)), table, delete, insert
+            )
+        )
+        self.refresh()
+
+    def refresh(self):
+        self.execute(
+            "INSERT INTO {0}({0}) VALUES ('rebuild')".format(self.quote(self.fts)),
+            "INSERT INTO {0}({0}) VALUES ('optimize')".format(self.quote(self.fts))
+        )
+
+    def drop(self):
+        self.execute(*['DROP TRIGGER IF EXISTS {}'.format(self.quote('{}_{}'.format(self.fts, suffix))) for suffix in (
+            'ai', 'ad', 'au'
+        )] + ['DROP TABLE IF EXISTS {}'.format(self.quote(self.fts))])
+
+    def lookup(self, q):
+        # every word of the query must be a substring of one of the indexed columns
+        words = q.split()
+        if not words or min(len(word) for word in words) < 3:
+            return reduce(operator.__or__, self.get_substring_lookups(q))
+        query = ' '.join('"{}"'.format(word.replace('"', '""')) for word in words)
+        return Q(RawSQL('{}.{} IN (SELECT rowid FROM {} WHERE {} MATCH %s)'.format(
+            self.quote(self.table), self.quote(self.model._meta.pk.column), self.quote(self.fts), self.quote(self.fts)
+        ), [query], output_field=BooleanField()))
+
+
+BACKENDS = dict(
+    postgresql='sloth.core.search.PostgresSearchBackend',
+    sqlite='sloth.core.search.SqliteSearchBackend'
+)
+
+
+def get_backend_cls(vendor):
+    path = getattr(settings, 'SEARCH_BACKENDS', {}).get(vendor, BACKENDS.get(vendor))
+    return import_string(path) if path else None
+
+
+def get_exists_key(model, using='default'):
+    return EXISTS_KEY.format(using, model._meta.label_lower)
+
+
+def get_search_backend(model, using='default'):
+    # the backend is only used after its index was built with the "search_index" command, which is checked at most
+    # once every SEARCH_INDEX_CHECK_INTERVAL seconds by each process (or as soon as the command changes the indexes)
+    cls = get_backend_cls(connections[using].vendor)
+    if cls is None:
+        return None
+    backend = cls(model, using=using)
+    if not backend.fields:
+        return None
+    key = get_exists_key(model, using)
+    exists = cache.get(key)
+    if exists is None:
+        exists = backend.exists()
+        cache.set(key, exists, getattr(settings, 'SEARCH_INDEX_CHECK_INTERVAL', 60))
+    return backend if exists else None
@@ -1,14 +1,61 @@
 # -*- coding: utf-8 -*-
 
 import json
+import datetime
 from decimal import Decimal
+from django.conf import settings
+from django.db.models import DateField, DateTimeField
 from django.db.models.aggregates import Count
+from django.db.models.functions import Trunc
+from django.utils import timezone
 from sloth.api.exceptions import HtmlReadyResponseException
+from sloth.core import rollup
 from django.template.loader import render_to_string
 from sloth.utils import pretty, colors
 
 
 MONTHS = 'JAN', 'FEV', 'MAR', 'ABR', 'MAI', 'JUN', 'JUL', 'AGO', 'SET', 'OUT', 'NOV', 'DEZ'
+PERIODS = 'day', 'week', 'month', 'quarter', 'year'
+
+
+def truncate(value, period):
+    if isinstance(value, datetime.datetime):
+        value = value.date()
+    if period == 'week':
+        return value - datetime.timedelta(days=value.weekday())
+    if period == 'month':
+        return value.replace(day=1)
+    if period == 'quarter':
+        return value.replace(month=(value.month - 1) // 3 * 3 + 1, day=1)
+    if period == 'year':
+        return value.replace(month=1, day=1)
+    return value
+
+
+def next_bucket(value, period):
+    if period in ('day', 'week'):
+        return value + datetime.timedelta(days=1 if period == 'day' else 7)
+    month = value.month - 1 + dict(month=1, quarter=3, year=12)[period]
+    return value.replace(year=value.year + month // 12, month=month % 12 + 1)
+
+
+def get_buckets(period, start, end):
+    buckets = []
+    value, end = truncate(start, period), truncate(end, period)
+    while value <= end:
+        buckets.append(value)
+        value = next_bucket(value, period)
+    return buckets
+
+
+def get_bucket_label(value, period):
+    if period == 'month':
+        return '{}/{}'.format(MONTHS[value.month - 1], value.year)
+    if period == 'quarter':
+        return '{}º TRI/{}'.format((value.month - 1) // 3 + 1, value.year)
+    if period == 'year':
+        return str(value.year)
+    return value.strftime('%d/%m/%Y')
 
 
 class QuerySetStatistics(object):
@@ -23,11 +70,12 @@ class QuerySetStatistics(object):
         self._yfield = None
         self._xdict = {}
         self._ydict = {}
-        self._values_dict = None
+        self._values = None
         self.cursor = 0
         self.request = None
         self.metadata = dict(uuid='123456', attr=None, source=None, template='', verbose_name=None)
         self.colors = {}
+        self._bucket = None
 
         if '__month' in x:
             self._xdict = {i + 1: month for i, month in enumerate(MONTHS)}
@@ -51,19 +99,12 @@ class QuerySetStatistics(object):
         return self.qs.get_allowed_attrs(recursive=recursive)
 
     def _calc(self):
-        if self._values_dict is None:
+        if self._values is None:
             self.calc()
 
-    def _xfield_display_value(self, value):
-        if hasattr(self._xfield, 'choices') and self._xfield.choices:
-            for choice in self._xfield.choices:
-                if choice[0] == value:
-                    return choice[1]
-        return value
-
-    def _yfield_display_value(self, value):
-        if hasattr(self._yfield, 'choices') and self._yfield.choices:
-            for choice in self._yfield.choices:
+    def _display_value(self, field, value):
+        if hasattr(field, 'choices') and field.choices:
+            for choice in field.choices:
                 if choice[0] == value:
                     return choice[1]
         return value
@@ -73,7 +114,7 @@ class QuerySetStatistics(object):
         self._yfield = None
         self._xdict = {}
         self._ydict = {}
-        self._values_dict = None
+        self._values = None
 
     def attr(self, name):
         self.metadata['attr'] = name
@@ -85,62 +126,93 @@ class QuerySetStatistics(object):
         self.metadata['source'] = name
         return self
 
-    def calc(self):
-        self._values_dict = {}
-        if self.y:
-            values_list = self.qs.values_list(self.x, self.y).annotate(self.func(self.z))
+    def bucket(self, period, start=None, end=None):
+        # groups the dates of the x axis by day, week, month, quarter or year in the database and includes the
+        # periods without values between "start" and "end" (or the first and the last periods found)
+        if period not in PERIODS:
+            raise ValueError('Invalid period "{}". Options are: {}'.format(period, ', '.join(PERIODS)))
+        self._clear()
+        self._bucket = period, start, end
+        return self
+
+    def _get_bucketed_queryset(self):
+        period, start, end = self._bucket
+        qs = self.qs
+        bounds = []
+        if start:
+            bounds.append(('gte', truncate(start, period)))
+        if end:
+            bounds.append(('lt', next_bucket(truncate(end, period), period)))
+        for lookup, value in bounds:
+            # the bounds are applied to the column itself so that its indexes can be used
+            if isinstance(self._xfield, DateTimeField):
+                value = datetime.datetime.combine(value, datetime.time.min)
+                value = timezone.make_aware(value) if settings.USE_TZ else value
+            qs = qs.filter(**{'{}__{}'.format(self.x, lookup): value})
+        return qs.annotate(statistics_bucket=Trunc(self.x, period, output_field=DateField()))
+
+    def _get_labels(self, field, keys):
+        # the labels (and colors) of related objects are fetched in a single query restricted to the grouped keys
+        related_model = field.related_model
+        objects = related_model.objects.filter(pk__in=[key for key in keys if key is not None])
+        if field is self._xfield and hasattr(related_model, 'cor'):
+            labels = {}
+            for obj in objects:
+                labels[obj.pk] = str(obj)
+                self.colors[obj.pk] = obj.cor
         else:
-            values_list = self.qs.values_list(self.x).annotate(self.func(self.z))
+            labels = {obj.pk: str(obj) for obj in objects}
+        if None in keys:
+            labels[None] = 'Não-Informado'
+        return labels
 
+    def calc(self):
+        # a single grouped query whose rows are pivoted into a dense matrix indexed by the keys of both axes
         self._xfield = self.qs.model.get_field(self.x.replace('__year', '').replace('__month', ''))
-        if self._xdict == {}:
-            xvalues = self.qs.values_list(self.x, flat=True).order_by(self.x).distinct()
+        self._yfield = self.qs.model.get_field(self.y.replace('__year', '').replace('__month', '')) if self.y else None
+        qs = self._get_bucketed_queryset() if self._bucket else self.qs
+        names = ['statistics_bucket' if self._bucket else self.x, self.y][:2 if self.y else 1]
+        ordering = [name for name, field in zip(names, [self._xfield, self._yfield]) if not field.related_model]
+        rows = None if self._bucket else rollup.aggregate(qs, names, self.func, self.z)
+        if rows is None:
+            rows = list(qs.values_list(*names).annotate(self.func(self.z)).order_by(*ordering))
+        else:
+            positions = [names.index(name) for name in ordering]
+            rows.sort(key=lambda row: [(row[i] is not None, row[i]) for i in positions])
+        if self._bucket:
+            period, start, end = self._bucket
+            dates = [row[0] for row in rows if row[0] is not None]
+            start, end = start or min(dates, default=None), end or max(dates, default=None)
+            buckets = get_buckets(period, start, end) if start and end else []
+            self._xdict = {bucket: get_bucket_label(bucket, period) for bucket in buckets}
+            if any(row[0] is None for row in rows):
+                self._xdict[None] = 'Não-Informado'
+        elif self._xdict == {}:
+            xkeys = list(dict.fromkeys(row[0] for row in rows))
             if self._xfield.related_model:
-                if hasattr(self._xfield.related_model, 'cor'):
-                    self.colors = {pk: color for pk, color in self._xfield.related_model.objects.values_list('id', 'cor')}
-                self._xdict = {
-                    obj.pk: str(obj) for obj in self._xfield.related_model.objects.filter(pk__in=xvalues)
-                }
+                self._xdict = self._get_labels(self._xfield, xkeys)
             else:
-                self._xdict = {
-                    value: value for value in self.qs.values_list(self.x, flat=True)
-                }
-            if None in xvalues:
-                self._xdict[None] = 'Não-Informado'
-        if self.y:
-            self._yfield = self.qs.model.get_field(self.y.replace('__year', '').replace('__month', ''))
-            yvalues = self.qs.values_list(self.y, flat=True).order_by(self.y).distinct()
-            if self._ydict == {}:
-                if self._yfield.related_model:
-                    self._ydict = {
-                        obj.pk: str(obj) for obj in self._yfield.related_model.objects.filter(pk__in=yvalues)
-                    }
-                else:
-                    self._ydict = {
-                        value: value for value in yvalues
-                    }
-            self._values_dict = {(vx, vy): calc for vx, vy, calc in values_list}
-            if None in yvalues:
-                self._ydict[None] = 'Não-Informado'
-        else:
-            self._ydict = {}
-            self._values_dict = {(vx, None): calc for vx, calc in values_list}
+                self._xdict = {key: 'Não-Informado' if key is None else key for key in xkeys}
+        if self.y and self._ydict == {}:
+            ykeys = sorted(set(row[1] for row in rows), key=lambda key: (key is not None, key))
+            if self._yfield.related_model:
+                self._ydict = self._get_labels(self._yfield, ykeys)
+            else:
+                self._ydict = {key: 'Não-Informado' if key is None else key for key in ykeys}
+        xindex = {key: i for i, key in enumerate(self._xdict)}
+        yindex = {key: j for j, key in enumerate(self._ydict)} if self._ydict else {None: 0}
+        self._values = [[0] * len(xindex) for _ in range(len(yindex))]
+        for row in rows:
+            i, j = xindex.get(row[0]), yindex.get(row[1] if self._ydict else None)
+            if i is not None and j is not None:
+                self._values[j][i] = row[-1]
 
     def tabulate(self):
         self._calc()
-        rows = []
-        row = []
-        row.append('')
-        for info in self._xdict.values():
-            row.append(info)
-        rows.append(row)
-        for i in self._xdict:
-            row = []
-            for j in self._ydict:
-                if not row:
-                    row.append(self._ydict[j])
-                row.append(self._values_dict.get((i, j), 0))
-            rows.append(row)
+        rows = [['', *self._xdict.values()]]
+        ylabels = list(self._ydict.values())
+        for i in range(len(self._xdict)):
+            rows.append([ylabels[0], *[values[i] for values in self._values]] if ylabels else [])
         return rows
 
     def filter(self, **kwargs):
@@ -168,25 +240,17 @@ class QuerySetStatistics(object):
             def format_value(value):
                 return float(value) if isinstance(value, Decimal) else value
 
+            self.cursor = 0
+            xlabels = [formatter.get(xv, str(self._display_value(self._xfield, xv))) for xv in self._xdict.values()]
+            xcolors = [self.nex_color(xk) for xk in self._xdict]
             if self._ydict:
-                for i, (yk, yv) in enumerate(self._ydict.items()):
-                    data = []
-                    self.cursor = 0
-                    for j, (xk, xv) in enumerate(self._xdict.items()):
-                        data.append([formatter.get(xv, str(self._xfield_display_value(xv))), format_value(self._values_dict.get((xk, yk), 0)), self.nex_color(xk)])
-                    series.update(**{formatter.get(yv, str(self._yfield_display_value(yv))): data})
-                ty = []
-                for k, serie in series.items():
-                    sy = 0
-                    ly = len(serie)
-                    for i, item in enumerate(serie):
-                        sy += item[1]
-                    ty.append(sy)
-                tx = [0 for i in range(0, ly)]
-                # breakpoint()
-                for i in range(0, len(tx)):
-                    for kj in series:
-                        tx[i] += series[kj][i][1]
+                for yv, values in zip(self._ydict.values(), self._values):
+                    series.update(**{formatter.get(yv, str(self._display_value(self._yfield, yv))): [
+                        [label, format_value(value), color] for label, value, color in zip(xlabels, values, xcolors)
+                    ]})
+                matrix = [[item[1] for item in serie] for serie in series.values()]
+                ty = [sum(values) for values in matrix]
+                tx = [sum(values) for values in zip(*matrix)]
                 if len(tx) == len(ty) == 1:
                     tx = ty = []
                 elif len(tx) > 1 and len(ty) > 1:
@@ -199,14 +263,12 @@ class QuerySetStatistics(object):
                     if len(tx) > 2: ty.append(sum(ty))
                     tx = []
             else:
-                sx = 0
-                data = list()
-                for j, (xk, xv) in enumerate(self._xdict.items()):
-                    data.append([formatter.get(xv, str(self._xfield_display_value(xv))), format_value(self._values_dict.get((xk, None), 0)), self.nex_color(xk)])
-                    sx+=data[-1][1]
+                data = [
+                    [label, format_value(value), color] for label, value, color in zip(xlabels, self._values[0], xcolors)
+                ]
                 if data:
                     series['default'] = data
-                tx = [sx]
+                tx = [sum(item[1] for item in data)]
         if self.request and path is None:
             prefix = self.request.path.split('/')[1]
             path = self.request.path.replace('/{}'.format(prefix), '')
@@ -258,7 +320,7 @@ class QuerySetStatistics(object):
             total = sum([item[1] for item in series['default']])
             start = 0
             for item in series['default']:
-                percent = int(item[1] * 100 / total)
+                percent = int(item[1] * 100 / total) if total else 0
                 end = start + percent
                 data['default'].append(dict(
                     description=item[0], percentage=percent,
@@ -3,14 +3,20 @@ import json
 import types
 from uuid import uuid1
 import pprint
-from functools import lru_cache
-from django.core.cache import cache
+from functools import lru_cache, partial
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.db import connections
 from django.db.models import Model
 from django.template.loader import render_to_string
+from django.utils import timezone, translation
 from sloth.actions import Action, ACTIONS
 from sloth.api.templatetags.tags import is_ajax
 from sloth.core.queryset import QuerySet
+from sloth.core.cache import TableRecorder, cached_fragment, get_attr_cache_key, get_attr_tables, get_stale, get_fresh, set_stale, record_tables
 from sloth.core.statistics import QuerySetStatistics
+from sloth.core.warmer import register
 from sloth.utils import getattrr, serialize, pretty, to_snake_case
 
 
@@ -47,6 +53,48 @@ def is_fieldset_group(item):
     return False
 
 
+SKIP = object()
+
+
+def merge_related_objects(obj, fetched):
+    for name, value in fetched._state.fields_cache.items():
+        current = obj._state.fields_cache.get(name)
+        if current is None:
+            obj._state.fields_cache[name] = value
+        elif value is not None:
+            merge_related_objects(current, value)
+
+
+def select_related_objects(instance, paths):
+    # loads the foreign keys that are not cached in the instance yet with a single query, when it saves queries
+    pending, missing = [], set()
+    for path in dict.fromkeys(paths):
+        obj, tokens = instance, path.split('__')
+        for i, name in enumerate(tokens):
+            field = obj._meta.get_field(name)
+            if not field.is_cached(obj):
+                pending.append(path)
+                missing.update('__'.join(tokens[:j + 1]) for j in range(i, len(tokens)))
+                break
+            obj = field.get_cached_value(obj)
+            if obj is None:
+                break
+    if len(missing) > 1:
+        fetched = type(instance)._base_manager.select_related(*pending).filter(pk=instance.pk).first()
+        if fetched is not None:
+            merge_related_objects(instance, fetched)
+
+
+def reuse_prefetched_objects(manager, qs):
+    # the rows of a relation loaded by prefetch_related are kept in the queryset of the display when it does not
+    # filter, order or slice them in another way; filters applied afterwards (e.g. role lookups) clone it again
+    prefetched = manager.get_queryset()
+    if prefetched._result_cache is not None and qs._result_cache is None and not qs.query.is_sliced:
+        if qs.query.where == prefetched.query.where and qs.query.order_by == prefetched.query.order_by:
+            qs._result_cache = prefetched._result_cache
+            qs._prefetch_done = True
+
+
 class ValueSet(dict):
     def __init__(self, instance, names):
         self.path = None
@@ -57,7 +105,8 @@ class ValueSet(dict):
             model=type(instance), names={}, metadata=[], actions=[], type=None, attr=None, source=None,
             attach=[], append=[], image=None, template=None, primitive=True, verbose_name=None,
             title=None, subtitle=None, status=None, icon=None, only=[], refresh={}, inline_actions=[],
-            cards=[], shortcuts=[], collapsed=False, printing=False, readonly=False
+            cards=[], shortcuts=[], collapsed=False, printing=False, readonly=False, parallel=False,
+            warming=None, planned=False, prepared={}
         )
         for attr_name in names:
             if isinstance(attr_name, tuple):
@@ -78,6 +127,10 @@ class ValueSet(dict):
         self.metadata['readonly'] = True
         return self
 
+    def parallel(self, flag=True):
+        self.metadata['parallel'] = flag
+        return self
+
     def actions(self, *names):
         self.metadata['actions'] = [to_snake_case(name) for name in names]
         return self
@@ -209,156 +262,254 @@ class ValueSet(dict):
             return schema
         return dict(type='object', properties=schema)
 
+    def get_preparable(self, attr_name):
+        # methods that can be evaluated before the value set is loaded (i.e. not cached nor loaded asynchronously)
+        attr = getattr(self.instance, attr_name, None)
+        if not isinstance(attr, types.MethodType) or getattr(attr, '__cache__', 0) or getattr(attr, '__assyncronous__', False):
+            return None
+        if attr_name in ACTIONS or not (self.request is None or self.instance.has_attr_permission(self.request.user, attr_name)):
+            return None
+        return attr
+
+    def prepare(self, attr_name):
+        # methods evaluated while planning are not evaluated again when the value set is loaded
+        attr = self.get_preparable(attr_name)
+        if attr is None:
+            return None
+        value = attr()
+        self.metadata['prepared'][attr_name] = value
+        return value
+
+    def get_related_paths(self, prefix='', paths=None):
+        # foreign keys reached by the names of the tree, including the ones of the nested value sets whose instance
+        # is the same object or an object already cached in one of its foreign keys
+        paths = [] if paths is None else paths
+        model = type(self.instance)
+        for attr_name in self.metadata['names']:
+            kind, path = model.get_lookup_plan(attr_name)
+            if kind == 'related':
+                paths.append('{}{}'.format(prefix, path))
+            elif kind == 'method' and not self.metadata['parallel']:
+                # the methods of parallel value sets are only evaluated by the pool
+                value = self.prepare(attr_name)
+                if isinstance(value, ValueSet) and isinstance(value.instance, Model):
+                    value.contextualize(self.request)
+                    if value.instance is self.instance:
+                        value.metadata['planned'] = True
+                        value.get_related_paths(prefix, paths)
+                    else:
+                        for name, obj in self.instance._state.fields_cache.items():
+                            if obj is value.instance:
+                                value.metadata['planned'] = True
+                                value.get_related_paths('{}{}__'.format(prefix, name), paths)
+                                break
+        return paths
+
     def load(self, wrap=True, detail=False, deep=0):
         if self.metadata['names']:
-            is_app = self.request and self.request.path.startswith('/app/')
+            if isinstance(self.instance, Model) and not self.metadata['planned']:
+                self.metadata['planned'] = True
+                select_related_objects(self.instance, self.get_related_paths())
+            if self.metadata['parallel']:
+                self.prepare_in_parallel()
             for i, (attr_name, width) in enumerate(self.metadata['names'].items()):
-                if self.request is None or self.instance.has_attr_permission(self.request.user, attr_name):
-                    path = self.path
-                    if path and self.metadata['attr'] is None and attr_name != 'all':
-                        tokens = path.split('?')
-                        path = '{}{}/'.format(tokens[0], attr_name)
-                        if len(tokens) == 2:
-                            path = '{}?{}'.format(path, tokens[1])
-                    if self.request and self.request.META.get('QUERY_STRING'):
-                        path = '{}?{}'.format(path, self.request.META.get('QUERY_STRING').replace('?tab=1', ''))
-
-                    form_cls = ACTIONS.get(attr_name, None)
-                    if form_cls:
-                        if form_cls.check_fake_permission(request=self.request, instantiator=self.instance):
-                            form = form_cls(request=self.request)
-                            form.path = path
-                            if form.is_valid():
-                                pass
-                            data = form.serialize(wrap=wrap)
-                            if self.request.path.startswith('/app/'):
-                                data.update(form=form)
-                            self[attr_name] = data
-                        continue
-
-                    lazy = (wrap and (deep > 1 or (deep > 0 and i > 0)) and self.metadata['template'] is None) and not self.metadata['printing']
-                    attr = getattr(self.instance, attr_name)
-
-                    cachetime = getattr(attr, '__cache__', 0)
-                    cachekey = cachetime and self.request and 'user:{}{}'.format(self.request.user.id, path) or None
-                    cachevalue = cache.get(cachekey) if cachekey else None
-                    assyncronous = getattr(attr, '__assyncronous__', False) and cachevalue is None and not is_ajax(self.request) and not self.metadata['source']
-                    value = None if (assyncronous or cachevalue) else (
-                        attr.all() if hasattr(attr, 'all') else (attr() if callable(attr) else attr)
-                    )
-                    if assyncronous:
-                        if wrap:
-                            template = getattr(attr, '__template__', None)
-                            template = 'renderers/{}.html'.format(template) if template else None
-                            data = dict(key=attr_name, type='assyncronous', path=path, template=template)
-                        else:
-                            data = None
-                    elif cachevalue:
-                        data = cachevalue
-                        # print('CACHED VALUE:', cachekey, data)
-                    elif isinstance(value, QuerySet) or hasattr(value, '_queryset_class'):  # RelatedManager
-                        qs = value if isinstance(value, QuerySet) else value.filter() # ManyRelatedManager
-                        qs.instantiator = self.instance
-                        qs.metadata['uuid'] = attr_name
-                        qs.metadata['path'] = path
-                        verbose_name = getattr(attr, '__verbose_name__', qs.metadata['verbose_name'])
-                        if verbose_name is None:
-                            verbose_name = pretty(attr_name)
-                        qs.verbose_name(verbose_name)
-                        template = getattr(attr, '__template__', None)
-                        template = 'renderers/{}.html'.format(template) if template else None
-                        if self.request:
-                            source = self.metadata['source'] if self.request.path.startswith('/api/') else None
-                            qs = qs.contextualize(self.request, source).apply_role_lookups(self.request.user)
-                        if wrap:
-                            if template or (self and self.metadata['primitive'] and deep > 0):
-                                data = dict(value=serialize(qs), width=width, type='primitive', path=path, template=template)
-                            else:
-                                self.metadata['primitive'] = False
-                                data = qs.serialize(path=path, wrap=wrap, lazy=lazy)
-                            data.update(name=verbose_name, key=attr_name)
-                        else:
-                            if self and self.metadata['primitive'] and deep > 0:  # one-to-many or many-to-many (and deep > 0)
-                                data = dict(value=serialize(qs), width=width, type='primitive', path=path, template=template)
-                            else:
-                                self.metadata['primitive'] = False
-                                data = qs.to_list(detail=False)
-                    elif isinstance(value, QuerySetStatistics):
-                        self.metadata['primitive'] = False
-                        statistics = value
-                        verbose_name = getattr(attr, '__verbose_name__', statistics.metadata['verbose_name'])
-                        if verbose_name is None:
-                            verbose_name = pretty(attr_name)
-                        statistics.contextualize(self.request)
-                        data = statistics.serialize(path=path, wrap=wrap, lazy=lazy)
-                        data.update(name=verbose_name, key=attr_name) if wrap else None
-                    elif isinstance(value, ValueSet):
-                        self.metadata['primitive'] = False
-                        valueset = value
-                        verbose_name = getattr(attr, '__verbose_name__', valueset.metadata['verbose_name'])
-                        if verbose_name is None:
-                            verbose_name = pretty(attr_name)
-                        valueset.contextualize(self.request)
-                        value.metadata['printing'] = self.metadata['printing']
-                        key = attr_name
-                        inner_deep = 0 if self.metadata['attr'] or (deep==1 and i==0) else deep+1
-                        valueset.path = path
-                        valueset.load(wrap=wrap, detail=wrap or detail, deep=inner_deep)
-                        if not valueset:
-                            continue
-                        refresh = valueset.refresh_data()
-                        collapsed = valueset.metadata['collapsed']
-                        data = dict(uuid=uuid1().hex, type='fieldset', name=verbose_name,
-                            key=key, refresh=refresh, metadata=dict(actions={}), data=valueset, path=path, collapsed=collapsed
-                        ) if wrap else valueset
-                        if self.request and self.request.path.startswith('/app/'):
-                            data.update(instance=valueset.instance)
-                        if wrap and not self.metadata['readonly']:
-                            for action_type in ('actions', 'inline_actions'):
-                                for form_name in valueset.metadata[action_type]:
-                                    form_cls = self.instance.action_form_cls(form_name)
-                                    if form_cls.check_fake_permission(self.request, valueset.instance, self.instance):
-                                        key = 'instance' if action_type == 'actions' else 'inline'
-                                        if key not in data['metadata']['actions']:
-                                            data['metadata']['actions'][key] = []
-                                        data['metadata']['actions'][key].append(form_cls.get_metadata(path))
-                            data.update(path=path)
-                            if valueset.metadata['image']:
-                                image = valueset.metadata['image']
-                                if image:
-                                    image = str(image)
-                                    if not image.startswith('/') and not image.startswith('http'):
-                                        image = '/media/{}'.format(image)
-                                    data.update(image=image)
-                            if valueset.metadata['template']:
-                                data.update(template='{}.html'.format(valueset.metadata['template']))
-                    else:
-                        path = '{}{}/'.format(self.path, attr_name)
-                        data = value
-                        verbose_name = pretty(self.metadata['model'].get_attr_metadata(attr_name)[0])
-                        if not is_app:
-                            data = serialize(data)
-                        if wrap or detail:
-                            template = getattr(attr, '__template__', None)
-                            metadata = getattr(attr, '__metadata__', None)
-                            if template:
-                                template = 'renderers/{}.html'.format(template)
-                            data = dict(key=attr_name, name=verbose_name, value=data, width=width, template=template, metadata=metadata, type='primitive', path=path)
-                    # if verbose:
-                    #     attr_name = verbose_name or pretty(self.metadata['model'].get_attr_metadata(attr_name)[0])
+                data = self.load_attr(i, attr_name, width, wrap, detail, deep, bool(self))
+                if data is not SKIP:
                     self[attr_name] = data
-                    if wrap and width == 0:
-                        self.auxiliar = True
-                        data.update(auxiliary=True)
-                    if cachetime and not assyncronous and not cachevalue:
-                        # print('CACHING VALUE:', cachekey, data, cachetime)
-                        cache.set(cachekey, data, timeout=cachetime)
         elif isinstance(self.instance, Model):
             self['id'] = self.instance.id
             self[self.metadata['model'].__name__.lower()] = str(self.instance)
 
         return self
 
+    def prepare_in_parallel(self):
+        # the methods are evaluated at the same time on a bounded pool and their values are then loaded in declaration
+        # order as in sequential loading; the connections of the pool do not see the writes of a transaction in
+        # progress, so the methods are evaluated sequentially inside atomic blocks
+        if any(connection.in_atomic_block for connection in connections.all()):
+            return
+        methods = {}
+        for attr_name in self.metadata['names']:
+            attr = None if attr_name in self.metadata['prepared'] else self.get_preparable(attr_name)
+            if attr is not None:
+                methods[attr_name] = attr
+        if len(methods) > 1:
+            workers = min(len(methods), getattr(settings, 'VALUESET_PARALLEL_WORKERS', 4))
+            context = TableRecorder.current(), translation.get_language(), timezone.get_current_timezone()
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                values = list(executor.map(partial(self.call_in_thread, context), methods.values()))
+            self.metadata['prepared'].update(zip(methods, values))
+
+    @staticmethod
+    def call_in_thread(context, method):
+        recorder, language, tz = context
+        try:
+            with recorder.record() if recorder else nullcontext(), translation.override(language), timezone.override(tz):
+                return method()
+        finally:
+            connections.close_all()
+
+    def load_attr(self, i, attr_name, width, wrap, detail, deep, loaded):
+        is_app = self.request and self.request.path.startswith('/app/')
+        if not (self.request is None or self.instance.has_attr_permission(self.request.user, attr_name)):
+            return SKIP
+        path = self.path
+        if path and self.metadata['attr'] is None and attr_name != 'all':
+            tokens = path.split('?')
+            path = '{}{}/'.format(tokens[0], attr_name)
+            if len(tokens) == 2:
+                path = '{}?{}'.format(path, tokens[1])
+        if self.request and self.request.META.get('QUERY_STRING'):
+            path = '{}?{}'.format(path, self.request.META.get('QUERY_STRING').replace('?tab=1', ''))
+
+        form_cls = ACTIONS.get(attr_name, None)
+        if form_cls:
+            if form_cls.check_fake_permission(request=self.request, instantiator=self.instance):
+                form = form_cls(request=self.request)
+                form.path = path
+                if form.is_valid():
+                    pass
+                data = form.serialize(wrap=wrap)
+                if self.request.path.startswith('/app/'):
+                    data.update(form=form)
+                return data
+            return SKIP
+
+        lazy = (wrap and (deep > 1 or (deep > 0 and i > 0)) and self.metadata['template'] is None) and not self.metadata['printing']
+        if '__' in attr_name and not attr_name.startswith('__'):  # fk traversal (e.g. "estado__sigla")
+            attr = getattrr(self.instance, attr_name)[0]
+        else:
+            attr = getattr(self.instance, attr_name)
+
+        cachetime = getattr(attr, '__cache__', 0)
+        cachekey = cachetime and self.request and get_attr_cache_key(attr, self.request, path) or None
+        if cachekey and self.metadata['warming'] is not None:
+            cachevalue = get_fresh(cachekey, self.metadata['warming'])
+        else:
+            cachevalue = get_stale(cachekey) if cachekey else None
+        if cachevalue is not None:
+            record_tables(get_attr_tables(attr))
+        assyncronous = getattr(attr, '__assyncronous__', False) and cachevalue is None and not is_ajax(self.request) and not self.metadata['source']
+        if assyncronous or cachevalue:
+            value = None
+        elif attr_name in self.metadata['prepared']:
+            value = self.metadata['prepared'].pop(attr_name)
+        else:
+            value = attr.all() if hasattr(attr, 'all') else (attr() if callable(attr) else attr)
+        if assyncronous:
+            if wrap:
+                template = getattr(attr, '__template__', None)
+                template = 'renderers/{}.html'.format(template) if template else None
+                data = dict(key=attr_name, type='assyncronous', path=path, template=template)
+            else:
+                data = None
+        elif cachevalue:
+            data = cachevalue
+            # print('CACHED VALUE:', cachekey, data)
+        elif isinstance(value, QuerySet) or hasattr(value, '_queryset_class'):  # RelatedManager
+            qs = value if isinstance(value, QuerySet) else value.filter() # ManyRelatedManager
+            if hasattr(attr, 'get_queryset') and hasattr(attr, 'instance'):  # RelatedManager
+                reuse_prefetched_objects(attr, qs)
+            qs.instantiator = self.instance
+            qs.metadata['uuid'] = attr_name
+            qs.metadata['path'] = path
+            verbose_name = getattr(attr, '__verbose_name__', qs.metadata['verbose_name'])
+            if verbose_name is None:
+                verbose_name = pretty(attr_name)
+            qs.verbose_name(verbose_name)
+            template = getattr(attr, '__template__', None)
+            template = 'renderers/{}.html'.format(template) if template else None
+            if self.request:
+                source = self.metadata['source'] if self.request.path.startswith('/api/') else None
+                qs = qs.contextualize(self.request, source).apply_role_lookups(self.request.user)
+            if wrap:
+                if template or (loaded and self.metadata['primitive'] and deep > 0):
+                    data = dict(value=serialize(qs), width=width, type='primitive', path=path, template=template)
+                else:
+                    self.metadata['primitive'] = False
+                    data = qs.serialize(path=path, wrap=wrap, lazy=lazy)
+                data.update(name=verbose_name, key=attr_name)
+            else:
+                if loaded and self.metadata['primitive'] and deep > 0:  # one-to-many or many-to-many (and deep > 0)
+                    data = dict(value=serialize(qs), width=width, type='primitive', path=path, template=template)
+                else:
+                    self.metadata['primitive'] = False
+                    data = qs.to_list(detail=False)
+        elif isinstance(value, QuerySetStatistics):
+            self.metadata['primitive'] = False
+            statistics = value
+            verbose_name = getattr(attr, '__verbose_name__', statistics.metadata['verbose_name'])
+            if verbose_name is None:
+                verbose_name = pretty(attr_name)
+            statistics.contextualize(self.request)
+            data = statistics.serialize(path=path, wrap=wrap, lazy=lazy)
+            data.update(name=verbose_name, key=attr_name) if wrap else None
+        elif isinstance(value, ValueSet):
+            self.metadata['primitive'] = False
+            valueset = value
+            if getattr(attr, '__parallel__', False):
+                valueset.parallel()
+            verbose_name = getattr(attr, '__verbose_name__', valueset.metadata['verbose_name'])
+            if verbose_name is None:
+                verbose_name = pretty(attr_name)
+            valueset.contextualize(self.request)
+            value.metadata['printing'] = self.metadata['printing']
+            key = attr_name
+            inner_deep = 0 if self.metadata['attr'] or (deep==1 and i==0) else deep+1
+            valueset.path = path
+            valueset.load(wrap=wrap, detail=wrap or detail, deep=inner_deep)
+            if not valueset:
+                return SKIP
+            refresh = valueset.refresh_data()
+            collapsed = valueset.metadata['collapsed']
+            data = dict(uuid=uuid1().hex, type='fieldset', name=verbose_name,
+                key=key, refresh=refresh, metadata=dict(actions={}), data=valueset, path=path, collapsed=collapsed
+            ) if wrap else valueset
+            if self.request and self.request.path.startswith('/app/'):
+                data.update(instance=valueset.instance)
+            if wrap and not self.metadata['readonly']:
+                for action_type in ('actions', 'inline_actions'):
+                    for form_name in valueset.metadata[action_type]:
+                        form_cls = self.instance.action_form_cls(form_name)
+                        if form_cls.check_fake_permission(self.request, valueset.instance, self.instance):
+                            key = 'instance' if action_type == 'actions' else 'inline'
+                            if key not in data['metadata']['actions']:
+                                data['metadata']['actions'][key] = []
+                            data['metadata']['actions'][key].append(form_cls.get_metadata(path))
+                data.update(path=path)
+                if valueset.metadata['image']:
+                    image = valueset.metadata['image']
+                    if image:
+                        image = str(image)
+                        if not image.startswith('/') and not image.startswith('http'):
+                            image = '/media/{}'.format(image)
+                        data.update(image=image)
+                if valueset.metadata['template']:
+                    data.update(template='{}.html'.format(valueset.metadata['template']))
+        else:
+            path = '{}{}/'.format(self.path, attr_name)
+            data = value
+            verbose_name = pretty(self.metadata['model'].get_attr_metadata(attr_name)[0])
+            if not is_app:
+                data = serialize(data)
+            if wrap or detail:
+                template = getattr(attr, '__template__', None)
+                metadata = getattr(attr, '__metadata__', None)
+                if template:
+                    template = 'renderers/{}.html'.format(template)
+                data = dict(key=attr_name, name=verbose_name, value=data, width=width, template=template, metadata=metadata, type='primitive', path=path)
+        # if verbose:
+        #     attr_name = verbose_name or pretty(self.metadata['model'].get_attr_metadata(attr_name)[0])
+        if wrap and width == 0:
+            self.auxiliar = True
+            data.update(auxiliary=True)
+        if cachetime and not assyncronous and not cachevalue:
+            # print('CACHING VALUE:', cachekey, data, cachetime)
+            set_stale(cachekey, data, cachetime)
+            if getattr(attr, '__warm__', False) and self.metadata['warming'] is None:
+                register(self, attr, attr_name, width, wrap, detail, deep, loaded)
+        return data
+
     def __str__(self):
         if self.request:
             return self.html()
@@ -422,6 +573,11 @@ class ValueSet(dict):
                 return self[list(self.metadata['names'].keys())[0]]
             return self
 
+    def get_fragment_identifiers(self):
+        instance = self.instance
+        return type(instance).__name__, getattr(instance, 'pk', None), list(self.metadata['names']), self.metadata['attr'], self.path
+
+    @cached_fragment
     def html(self, path=None, print=False):
         self.path = path if path else self.path
         self.metadata['printing'] = True
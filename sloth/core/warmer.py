@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+
+import time
+import hashlib
+import threading
+import traceback
+from importlib import import_module
+from django.apps import apps
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.exceptions import ObjectDoesNotExist
+from django.db import connections
+from django.db.models import Model
+from django.http import HttpRequest, QueryDict
+from django.utils.module_loading import import_string
+from sloth.core.cache import get_attr_owner, get_attr_tables, tables_changed
+
+RECIPE_KEY = 'sloth:warmer:recipe:{}'
+SLOT_KEY = 'sloth:warmer:slot:{}'
+LAST_SLOT_KEY = 'sloth:warmer:last'
+FIRST_SLOT_KEY = 'sloth:warmer:first'
+LOCK_KEY = 'sloth:warmer:lock'
+LOCK_TIMEOUT = 300
+RECIPE_METADATA = 'attr', 'source', 'template', 'primitive', 'printing', 'readonly'
+
+
+def register(valueset, attr, attr_name, width, wrap, detail, deep, loaded):
+    # stores what is needed to reproduce the request that computed an attribute decorated with @meta(warm=True),
+    # so the warmer can recompute it in background and requests always find its value in the cache; each recipe has
+    # its own key and a numbered slot pointing to it, both expiring after WARMER_RECIPE_TIMEOUT seconds (the attribute
+    # is registered again by the next request that computes it)
+    instance, request = valueset.instance, valueset.request
+    if isinstance(instance, Model):
+        model, cls = instance._meta.label, None
+    elif hasattr(instance, 'request'):  # dashboards
+        model, cls = None, '{}.{}'.format(type(instance).__module__, type(instance).__qualname__)
+    else:
+        return
+    query_string = request.META.get('QUERY_STRING', '')
+    # one recipe for each value of the cache (e.g. for each set of roles of the users of "role" scoped attributes)
+    owner = get_attr_owner(attr, request.user)
+    recipe_id = hashlib.md5('{}{}{}{}{}{}{}{}'.format(
+        model, cls, instance.pk if model else None, attr_name, valueset.path, request.path, query_string, owner
+    ).encode()).hexdigest()
+    recipe = dict(
+        model=model, cls=cls, pk=instance.pk if model else None, attr_name=attr_name, width=width, wrap=wrap,
+        detail=detail, deep=deep, loaded=loaded, metadata={k: valueset.metadata[k] for k in RECIPE_METADATA},
+        valueset_path=valueset.path, path=request.path, query_string=query_string, user_id=request.user.id,
+        ajax=request.headers.get('x-requested-with') == 'XMLHttpRequest', tables=sorted(get_attr_tables(attr))
+    )
+    Warmer.tables.update(recipe['tables'])
+    timeout = getattr(settings, 'WARMER_RECIPE_TIMEOUT', 86400)
+    if cache.add(RECIPE_KEY.format(recipe_id), recipe, timeout):
+        cache.add(LAST_SLOT_KEY, 0, None)
+        cache.set(SLOT_KEY.format(cache.incr(LAST_SLOT_KEY)), recipe_id, timeout)
+    Warmer.launch()
+
+
+def get_recipes():
+    # the slots expire in the order they were taken, so the leading expired ones are never read again
+    first, last = cache.get(FIRST_SLOT_KEY) or 1, cache.get(LAST_SLOT_KEY) or 0
+    slots = cache.get_many([SLOT_KEY.format(slot) for slot in range(first, last + 1)])
+    for slot in range(first, last + 1):
+        if SLOT_KEY.format(slot) in slots:
+            break
+        first = slot + 1
+    cache.set(FIRST_SLOT_KEY, first, None)
+    recipes = cache.get_many([RECIPE_KEY.format(recipe_id) for recipe_id in slots.values()])
+    return {key.split(':')[-1]: recipe for key, recipe in recipes.items()}
+
+
+def get_request(recipe):
+    request = HttpRequest()
+    request.method = 'GET'
+    request.path = request.path_info = recipe['path']
+    request.META.update(SERVER_NAME='localhost', SERVER_PORT='80', QUERY_STRING=recipe['query_string'])
+    if recipe['ajax']:
+        request.META.update(HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+    request.GET = QueryDict(recipe['query_string'])
+    request.user = get_user_model().objects.get(pk=recipe['user_id'])
+    request.session = import_module(settings.SESSION_ENGINE).SessionStore()
+    return request
+
+
+def warm(recipe, margin=0):
+    # recomputes the attribute if its value is missing in the cache or expires within "margin" seconds
+    from sloth.core.valueset import ValueSet
+    request = get_request(recipe)
+    if recipe['model']:
+        instance = apps.get_model(recipe['model'])._default_manager.get(pk=recipe['pk'])
+    else:
+        instance = import_string(recipe['cls'])(request)
+    valueset = ValueSet(instance, [recipe['attr_name']])
+    valueset.metadata.update(recipe['metadata'], warming=margin)
+    valueset.path = recipe['valueset_path']
+    valueset.request = request
+    valueset.load_attr(
+        0, recipe['attr_name'], recipe['width'], recipe['wrap'], recipe['detail'], recipe['deep'], recipe['loaded']
+    )
+
+
+def warm_all(margin=0):
+    # a single process runs each round, the others skip it while the lock is held
+    if not cache.add(LOCK_KEY, 1, LOCK_TIMEOUT):
+        return 0
+    try:
+        total = 0
+        for recipe_id, recipe in get_recipes().items():
+            Warmer.tables.update(recipe['tables'])
+            try:
+                warm(recipe, margin)
+                total += 1
+            except ObjectDoesNotExist:
+                cache.delete(RECIPE_KEY.format(recipe_id))
+            except Exception:
+                traceback.print_exc()
+        return total
+    finally:
+        cache.delete(LOCK_KEY)
+
+
+class Warmer(threading.Thread):
+    # daemon thread started in the web processes when settings.WARMER_INTERVAL is defined; it runs on every
+    # interval and as soon as the tables the registered attributes depend on are changed
+    instance = None
+    lock = threading.Lock()
+    tables = set()
+
+    def __init__(self, interval):
+        super().__init__(daemon=True, name='sloth-warmer')
+        self.interval = interval
+        self.event = threading.Event()
+
+    @classmethod
+    def launch(cls):
+        interval = getattr(settings, 'WARMER_INTERVAL', None)
+        if interval and cls.instance is None:
+            with cls.lock:
+                if cls.instance is None:
+                    cls.instance = cls(interval)
+                    cls.instance.start()
+
+    @classmethod
+    def wake(cls, sender, tables, **kwargs):
+        if cls.instance and cls.tables.intersection(tables):
+            cls.instance.event.set()
+
+    def run(self):
+        while True:
+            self.event.wait(self.interval)
+            if self.event.is_set():
+                # waits a little so that a burst of changes triggers a single round
+                time.sleep(1)
+            self.event.clear()
+            try:
+                warm_all(margin=self.interval)
+            finally:
+                connections.close_all()
+
+
+tables_changed.connect(Warmer.wake, dispatch_uid='sloth_warmer_tables_changed')
@@ -69,7 +69,9 @@ def serialize(obj, identifier=False):
         elif hasattr(obj, 'pk'):
             return obj.pk if identifier else str(obj)
         elif hasattr(obj, 'all'):
-            return [o.pk if identifier else str(o) for o in obj.filter()]
+            # an evaluated queryset (e.g. prefetched rows) is not cloned, which would query it again
+            objs = obj if getattr(obj, '_result_cache', None) is not None else obj.filter()
+            return [o.pk if identifier else str(o) for o in objs]
         elif isinstance(obj, FieldFile):
             return obj and obj.url or '/static/images/no-image.png'
         return str(obj)
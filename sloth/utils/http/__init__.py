@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 import os
+import json
 import xlwt
 import csv
 import requests
@@ -7,7 +8,8 @@ import tempfile
 import datetime
 from tempfile import mktemp
 from django.conf import settings
-from django.http import HttpResponse, JsonResponse
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from django.template.loader import render_to_string
 
 
@@ -20,6 +22,37 @@ class ApiResponse(JsonResponse):
         self["X-Frame-Options"] = "SAMEORIGIN"
 
 
+class StreamingApiResponse(StreamingHttpResponse):
+    CONTENT_TYPES = {'ndjson': 'application/x-ndjson', 'json': 'application/json'}
+
+    def __init__(self, rows, format='ndjson', **kwargs):
+        kwargs.update(content_type=self.CONTENT_TYPES[format])
+        super().__init__(self.ndjson(rows) if format == 'ndjson' else self.json(rows), **kwargs)
+        self["Access-Control-Allow-Origin"] = "*"
+        self["Access-Control-Allow-Headers"] = "*"
+        self["X-Frame-Options"] = "SAMEORIGIN"
+
+    @classmethod
+    def get_format(cls, request):
+        # requested with ?stream=json|ndjson or with the "Accept: application/x-ndjson" header
+        stream = request.GET.get('stream')
+        if stream is None and 'application/x-ndjson' in request.headers.get('Accept', ''):
+            stream = 'ndjson'
+        return stream if stream in cls.CONTENT_TYPES else None
+
+    @staticmethod
+    def ndjson(rows):
+        for row in rows:
+            yield '{}\n'.format(json.dumps(row, cls=DjangoJSONEncoder, ensure_ascii=False))
+
+    @staticmethod
+    def json(rows):
+        yield '['
+        for i, row in enumerate(rows):
+            yield '{}{}'.format(',' if i else '', json.dumps(row, cls=DjangoJSONEncoder, ensure_ascii=False))
+        yield ']'
+
+
 class XlsResponse(HttpResponse):
     def __init__(self, data):
         wb = xlwt.Workbook(encoding='iso8859-1')
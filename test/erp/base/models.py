@@ -61,6 +61,10 @@ class Estado(models.Model):
     def get_dados_gerais(self):
         return self.value_set('id', ('sigla', 'endereco'), 'get_historia')
 
+    @meta('Total de Municípios', cache=60, cache_scope='global', depends=('base.Municipio',), warm=True)
+    def get_total_municipios(self):
+        return self.municipio_set.count()
+
     def view(self):
         return self.value_set('get_dados_gerais', 'get_cidades').actions(
             'FazerAlgumaCoisa', 'Edit', 'InformarCidadesMetropolitanas'
@@ -272,6 +276,7 @@ class Servidor(models.Model):
         verbose_name = 'Servidor'
         verbose_name_plural = 'Servidores'
         select_fields = 'get_foto', 'nome', 'matricula', 'cpf'
+        search_fields = 'nome', 'matricula'
 
     def __str__(self):
         return self.nome
@@ -366,6 +371,7 @@ class Ferias(models.Model):
     class Meta:
         verbose_name = 'Férias'
         verbose_name_plural = 'Férias'
+        rollups = [('servidor', 'ano', 'inicio__month'), ('ano', 'inicio')]
 
     def get_periodo(self):
         return 'de {} a {}'.format(self.inicio, self.fim)
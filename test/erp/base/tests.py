@@ -1,11 +1,13 @@
 # -*- coding: utf-8 -*-
 import os
 import json
+import threading
 from datetime import date, datetime
 from django.contrib.auth.models import Group
-from django.test import TestCase
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
 from oauth2_provider.generators import generate_client_id
 
+from sloth.api.models import User
 from sloth.test import ServerTestCase
 from .models import Estado, Municipio, Endereco, Servidor, Ferias, Frequencia
 
@@ -32,6 +34,16 @@ def loaddata():
     Group.objects.create(name='Administrador')
 
 
+def create_superuser(username='admin'):
+    return User.objects.create(username=username, is_superuser=True)
+
+
+def create_request(user, path='/', data=None, **extra):
+    request = RequestFactory().get(path, data or {}, **extra)
+    request.user = user
+    return request
+
+
 class ModelTestCase(TestCase):
 
     def __init__(self, *args, **kwargs):
@@ -73,6 +85,674 @@ class ModelTestCase(TestCase):
         self.log(Servidor.objects.com_endereco().serialize(), dumps=False)
         self.log(Servidor.objects.sem_endereco().serialize(), dumps=False)
 
+    def test_row_plan(self):
+        from .models import Telefone
+        request = create_request(create_superuser())
+        for n in (3, 6):
+            while Estado.objects.count() < n:
+                i = Estado.objects.count()
+                estado = Estado.objects.create(sigla='E{}'.format(i))
+                municipio = Municipio.objects.create(nome='M{}'.format(i), estado=estado)
+                estado.endereco = Endereco.objects.create(logradouro='Centro', numero=i, municipio=municipio)
+                estado.save()
+                estado.cidades_metropolitanas.add(municipio)
+                estado.telefones.add(Telefone.objects.create(ddd=84, numero='99999-000{}'.format(i)))
+            # the list, its nested foreign keys and the two prefetched relations are read by the same number of queries
+            with self.assertNumQueries(3):
+                data = Estado.objects.all().contextualize(request).serialize()
+            self.assertEqual(len(data), n)
+            self.assertEqual(data[-1]['endereco'], 'Centro, {0}, M{0}/E{0}'.format(n - 1))
+            self.assertEqual(data[-1]['cidades_metropolitanas'], [dict(id=str(n), nome='M{}'.format(n - 1), estado='E{}'.format(n - 1))])
+            self.assertEqual([item['numero'] for item in data[-1]['telefones']], ['99999-000{}'.format(n - 1)])
+        plan = Ferias.objects.display('servidor__nome', 'ano', 'get_periodo').get_row_plan(add_id=True)
+        self.assertEqual(plan['columns'], {'id': 'field', 'servidor__nome': 'related', 'ano': 'field', 'get_periodo': 'method'})
+        self.assertEqual(plan['select_related'], ['servidor'])
+
+    def test_keyset_pagination(self):
+        rn = Estado.objects.create(sigla='RN')
+        for nome in ('Natal', 'Mossoró', 'Caicó', 'Assu', 'Parnamirim'):
+            Municipio.objects.create(nome=nome, estado=rn)
+        page = Municipio.objects.all().display('nome').order_by('nome').limit_per_page(2).keyset().serialize()
+        self.assertEqual([item['nome'] for item in page['data']], ['Assu', 'Caicó'])
+        self.assertIsNone(page['previous'])
+        page = Municipio.objects.all().display('nome').order_by('nome').limit_per_page(2).keyset(page['next']).serialize()
+        self.assertEqual([item['nome'] for item in page['data']], ['Mossoró', 'Natal'])
+        next_page = Municipio.objects.all().display('nome').order_by('nome').limit_per_page(2).keyset(page['next']).serialize()
+        self.assertEqual([item['nome'] for item in next_page['data']], ['Parnamirim'])
+        self.assertIsNone(next_page['next'])
+        previous_page = Municipio.objects.all().display('nome').order_by('nome').limit_per_page(2).keyset(page['previous']).serialize()
+        self.assertEqual([item['nome'] for item in previous_page['data']], ['Assu', 'Caicó'])
+        self.assertIsNone(previous_page['previous'])
+        for i, data_nascimento in enumerate((None, date(1980, 1, 1), None, date(1990, 1, 1))):
+            Servidor.objects.create(matricula=i, nome='s{}'.format(i), cpf=i, data_nascimento=data_nascimento)
+        for lookup, expected in (('data_nascimento', ['s1', 's3', 's0', 's2']), ('-data_nascimento', ['s0', 's2', 's3', 's1'])):
+            names, cursor, pages = [], None, []
+            while True:
+                page = Servidor.objects.all().display('nome').order_by(lookup).limit_per_page(2).keyset(cursor).serialize()
+                names.extend(item['nome'] for item in page['data'])
+                pages.append(page)
+                cursor = page['next']
+                if cursor is None:
+                    break
+            self.assertEqual(names, expected)
+            page = Servidor.objects.all().display('nome').order_by(lookup).limit_per_page(2).keyset(pages[-1]['previous']).serialize()
+            self.assertEqual([item['nome'] for item in page['data']], expected[0:2])
+        page = Municipio.objects.all().display('nome').order_by('?').limit_per_page(2).keyset().serialize()
+        self.assertEqual(len(page['data']), 2)
+        self.assertIsNone(page['next'])
+        # invalid cursors and cursors of other orderings return the first page
+        for cursor in ('invalid', '{}x'.format(next_page['previous']), pages[-1]['next'] or pages[-1]['previous']):
+            page = Municipio.objects.all().display('nome').order_by('nome', 'estado').limit_per_page(2).keyset(cursor).serialize()
+            self.assertEqual([item['nome'] for item in page['data']], ['Assu', 'Caicó'])
+
+    def test_uncounted_pagination(self):
+        rn = Estado.objects.create(sigla='RN')
+        for nome in ('Natal', 'Mossoró', 'Caicó', 'Assu', 'Parnamirim'):
+            Municipio.objects.create(nome=nome, estado=rn)
+        qs = Municipio.objects.all().display('nome').order_by('nome').limit_per_page(2).uncounted()
+        pagination = qs.serialize(wrap=True)['metadata']['pagination']
+        self.assertIsNone(pagination['total'])
+        self.assertTrue(pagination['has_next'])
+        self.assertEqual(pagination['pages'], [1, 2])
+        qs.metadata['page'] = 3
+        data = qs.serialize(wrap=True)
+        self.assertFalse(data['metadata']['pagination']['has_next'])
+        self.assertEqual(data['metadata']['pagination']['interval'], (5, 5))
+        self.assertEqual(Municipio.objects.all().limit_per_page(2).get_pages(1000), [1, 2, 3, 4, 997, 998, 999, 1000])
+
+    def test_attach_counts(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from sloth.api.models import Task
+        user = User.objects.create(username='user')
+        Task.objects.create(user=user, name='A')
+        Task.objects.create(user=user, name='B', end=datetime.now())
+        Task.objects.create(user=user, name='C', end=datetime.now(), error='Erro')
+        with CaptureQueriesContext(connection) as context:
+            attach = Task.objects.all().get_attach()
+        self.assertEqual(len(context.captured_queries), 1)
+        counts = {name: item['count'] for name, item in attach.items()}
+        self.assertEqual(counts, dict(all=3, running=1, finished=1, unfinished=1, stopped=0))
+
+    def test_bulk_permissions(self):
+        rn = Estado.objects.create(sigla='RN')
+        natal = Municipio.objects.create(nome='Natal', estado=rn)
+        Municipio.objects.create(nome='Mossoró', estado=rn)
+        request = create_request(create_superuser())
+        calls = []
+
+        def has_view_permission_bulk(cls, user, objects):
+            calls.append(len(objects))
+            return [obj for obj in objects if obj.nome == 'Natal']
+
+        Municipio.has_view_permission_bulk = classmethod(has_view_permission_bulk)
+        try:
+            qs = Municipio.objects.all().display('nome').contextualize(request)
+            qs.metadata['view'] = [dict(name='self')]
+            data = qs.to_list(wrap=True)
+        finally:
+            del Municipio.has_view_permission_bulk
+        self.assertEqual(calls, [2])
+        self.assertEqual([item['id'] for item in data if 'self' in item['actions']], [natal.pk])
+
+    def test_stream(self):
+        from sloth.utils.http import StreamingApiResponse
+        Estado.objects.create(sigla='RN')
+        Estado.objects.create(sigla='PB')
+        qs = Estado.objects.all().contextualize(create_request(create_superuser()))
+        lines = list(StreamingApiResponse.ndjson(qs.stream(chunk_size=1)))
+        self.assertTrue(all(line.endswith('\n') and line.count('\n') == 1 for line in lines))
+        self.assertEqual([json.loads(line)['sigla'] for line in lines], ['RN', 'PB'])
+        # the rows are read through iterator(), without filling the result cache
+        self.assertIsNone(qs._result_cache)
+
+    def test_bulk_action_permissions(self):
+        from .actions import EditarSiglaEstado
+        rn = Estado.objects.create(sigla='RN')
+        Estado.objects.create(sigla='PB')
+        request = create_request(create_superuser())
+        calls = []
+
+        def has_permission_bulk(self, user, objects):
+            calls.append((user, len(objects)))
+            return [obj.pk for obj in objects if obj.sigla == 'RN']
+
+        def has_permission(self, user):
+            raise AssertionError('has_permission called for each object')
+
+        EditarSiglaEstado.has_permission_bulk = has_permission_bulk
+        EditarSiglaEstado.has_permission = has_permission
+        try:
+            data = Estado.objects.all().contextualize(request).to_list(wrap=True)
+        finally:
+            del EditarSiglaEstado.has_permission_bulk, EditarSiglaEstado.has_permission
+        name = EditarSiglaEstado.get_api_name()
+        self.assertEqual(calls, [(request.user, 2)])
+        self.assertEqual([item['id'] for item in data if name in item['actions']], [rn.pk])
+
+    def test_permission_hooks(self):
+        user = User.objects.create(username='user')
+        hooks = Servidor.get_permission_hooks()
+        self.assertEqual(hooks['get_dados_gerais'], 'has_get_dados_gerais_permission')
+        self.assertNotIn('nome', hooks)
+        servidor = Servidor(nome='Maria')
+        self.assertFalse(servidor.has_attr_permission(user, 'get_dados_gerais'))
+        self.assertTrue(servidor.has_attr_permission(user, 'nome'))
+
+    def test_routes(self):
+        from sloth.api import routes
+        tokens = ['base', 'servidor', '1', 'get_dados_gerais']
+        self.assertIs(routes.resolve(tokens), Servidor)
+        self.assertEqual(tokens, ['1', 'get_dados_gerais'])
+        tokens = ['user', '1']
+        self.assertIs(routes.resolve(tokens), User)
+        self.assertEqual(tokens, ['1'])
+        self.assertIsNone(routes.resolve(['base', 'inexistente']))
+        self.assertIsNone(routes.resolve(['get_indicadores']))
+        self.assertIs(routes.get_allowed_attrs(Servidor), routes.get_allowed_attrs(Servidor))
+        self.assertIn('ativos', routes.get_allowed_attrs(Servidor))
+
+    def test_related_paths(self):
+        loaddata()
+        servidor = Servidor.objects.get(pk=Servidor.objects.first().pk)
+        valueset = servidor.value_set('naturalidade', 'get_endereco', 'endereco__municipio')
+        self.assertEqual(valueset.get_related_paths(), ['naturalidade', 'endereco__municipio', 'endereco__municipio'])
+        servidor = Servidor.objects.get(pk=servidor.pk)
+        # the servidor with its foreign keys and the states of the municipalities (Municipio.__str__)
+        with self.assertNumQueries(3):
+            valueset = servidor.value_set('naturalidade', 'endereco__municipio').load(wrap=False)
+        self.assertEqual(valueset['naturalidade'], 'Natal/RN')
+
+    def test_search_index(self):
+        from django.core.cache import cache
+        from django.core.management import call_command
+        from sloth.core.search import get_search_backend, get_exists_key
+        loaddata()
+        call_command('search_index', 'base.servidor', stdout=open(os.devnull, 'w'))
+        try:
+            self.assertIsNotNone(get_search_backend(Servidor, 'default'))
+            self.assertEqual(Servidor.objects.search(q='bren silv').count(), 1)
+            Servidor.objects.update(nome='Emanoel Silva')
+            self.assertEqual(Servidor.objects.search(q='breno').count(), 0)
+            self.assertEqual(Servidor.objects.search(q='emanoel').count(), 1)
+            # substrings of the indexed columns are still found
+            self.assertEqual(Servidor.objects.search(q='manoel').count(), 1)
+            self.assertEqual(Servidor.objects.search(q='9479').count(), 1)
+            self.assertEqual(Servidor.objects.search(q='ma').count(), 1)
+            # the index is searched without scanning the table
+            self.assertNotRegex(Servidor.objects.search(q='manoel').explain(), r'SCAN base_servidor\b')
+        finally:
+            call_command('search_index', 'base.servidor', drop=True, stdout=open(os.devnull, 'w'))
+        self.assertIsNone(get_search_backend(Servidor, 'default'))
+        self.assertEqual(Servidor.objects.search(q='manoel').count(), 1)
+        # a process that still sees the index as existing notices its removal once the cached check expires
+        cache.set(get_exists_key(Servidor, 'default'), True)
+        self.assertIsNotNone(get_search_backend(Servidor, 'default'))
+        cache.delete(get_exists_key(Servidor, 'default'))
+        self.assertIsNone(get_search_backend(Servidor, 'default'))
+
+    def test_statistics(self):
+        loaddata()
+        natal = Municipio.objects.get(nome='Natal')
+        servidor = Servidor.objects.first()
+        Servidor.objects.create(
+            matricula='1', nome='Maria', cpf=servidor.cpf, data_nascimento=servidor.data_nascimento,
+            naturalidade=natal, ativo=False
+        )
+        statistics = Servidor.objects.count('naturalidade', 'ativo')
+        # the grouped query, the labels of the municipalities and the state of natal in Municipio.__str__
+        with self.assertNumQueries(3):
+            data = statistics.serialize()
+        self.assertEqual({key: [item[:2] for item in serie] for key, serie in data['series'].items()}, {
+            'Não': [['Natal/RN', 1]], 'Sim': [['Natal/RN', 1]]
+        })
+        self.assertEqual((data['tx'], data['ty']), ([2], []))
+        self.assertEqual(statistics.tabulate(), [['', 'Natal/RN'], [False, 1, 1]])
+
+    def test_statistics_buckets(self):
+        loaddata()
+        statistics = Ferias.objects.count('inicio').bucket('month', start=date(2020, 1, 15), end=date(2020, 4, 1))
+        self.assertEqual([item[:2] for item in statistics.serialize(wrap=False)], [
+            ['JAN/2020', 1], ['FEV/2020', 0], ['MAR/2020', 0], ['ABR/2020', 0]
+        ])
+        statistics = Ferias.objects.count('inicio').bucket('quarter')
+        self.assertEqual([item[:2] for item in statistics.serialize(wrap=False)], [
+            ['1º TRI/2020', 1], ['2º TRI/2020', 0], ['3º TRI/2020', 0], ['4º TRI/2020', 0],
+            ['1º TRI/2021', 0], ['2º TRI/2021', 0], ['3º TRI/2021', 1]
+        ])
+        statistics = Ferias.objects.count('inicio', 'ano').bucket('year')
+        self.assertEqual(statistics.tabulate(), [['', '2020', '2021'], [2020, 1, 0], [2020, 0, 1]])
+
+    def test_rollups(self):
+        from io import StringIO
+        from django.core.management import call_command
+        from sloth import threadlocals
+        from sloth.core.rollup import invalidate
+        loaddata()
+        servidor = Servidor.objects.first()
+        call_command('rollup', 'base.ferias', stdout=StringIO())
+        with self.assertNumQueries(1):
+            data = Ferias.objects.count('ano').serialize(wrap=False)
+        self.assertEqual(data, [['2020', 1, '#845EC2'], ['2021', 1, '#D65DB1']])
+        ferias = Ferias.objects.create(servidor=servidor, ano=2021, inicio=date(2021, 3, 1), fim=date(2021, 3, 31))
+        ferias.ano = 2022
+        ferias.save()
+        Ferias.objects.filter(ano=2020).first().delete()
+        Ferias.objects.create(servidor=servidor, ano=2022, inicio=date(2022, 3, 1), fim=date(2022, 3, 31))
+        queries = lambda: [
+            Ferias.objects.count('ano').serialize(wrap=False),
+            Ferias.objects.filter(ano=2022).count('inicio__month', 'servidor').serialize(wrap=False),
+            Ferias.objects.filter(servidor=servidor).count('inicio__month').serialize(wrap=False),
+        ]
+        with self.assertNumQueries(4):
+            data = queries()
+        self.assertEqual(data[0], [['2021', 1, '#845EC2'], ['2022', 2, '#D65DB1']])
+        invalidate(Ferias)
+        self.assertEqual(data, queries())
+        call_command('rollup', 'base.ferias', stdout=StringIO())
+        dates = lambda: [
+            Ferias.objects.filter(inicio=date(2022, 3, 1)).count('ano').serialize(wrap=False),
+            Ferias.objects.filter(ano=2022).count('inicio').serialize(wrap=False)
+        ]
+        with self.assertNumQueries(2):
+            data = dates()
+        self.assertEqual(data[0], [['2022', 1, '#845EC2']])
+        invalidate(Ferias)
+        self.assertEqual(data, dates())
+        call_command('rollup', 'base.ferias', stdout=StringIO())
+        Ferias.objects.bulk_create([Ferias(servidor=servidor, ano=2023, inicio=date(2023, 1, 1), fim=date(2023, 1, 31))])
+        self.assertEqual(Ferias.objects.count('ano').serialize(wrap=False)[-1], ['2023', 1, '#FF6F91'])
+        call_command('rollup', 'base.ferias', stdout=StringIO())
+        ferias.ano = 2023
+        ferias.save_base(raw=True)  # as loaddata does
+        self.assertEqual(Ferias.objects.count('ano').serialize(wrap=False)[-1], ['2023', 2, '#FF6F91'])
+        # the bookkeeping of the rollups is not part of the audit log of the request
+        call_command('rollup', 'base.ferias', stdout=StringIO())
+        threadlocals.transaction = dict(operation=None, diff=[])
+        try:
+            Ferias.objects.create(servidor=servidor, ano=2024, inicio=date(2024, 1, 1), fim=date(2024, 1, 31)).delete()
+            self.assertEqual(threadlocals.transaction, dict(operation=None, diff=[]))
+        finally:
+            del threadlocals.transaction
+        self.assertEqual(Ferias.objects.count('ano').serialize(wrap=False)[-1], ['2023', 2, '#FF6F91'])
+
+    def test_navigation_stack(self):
+        from unittest import mock
+        from importlib import import_module
+        from django.conf import settings
+        from django.test import Client
+        client = Client()
+        client.force_login(create_superuser())
+        client.get('/app/dashboard/')
+        client.get('/app/dashboard/base/estado/')
+        self.assertEqual(client.session['stack'], ['/app/dashboard/', '/app/dashboard/base/estado/'])
+        store = import_module(settings.SESSION_ENGINE).SessionStore
+        with mock.patch.object(store, 'save', autospec=True, side_effect=store.save) as save:
+            client.get('/app/dashboard/base/estado/')
+            self.assertEqual(save.call_count, 0)
+            client.get('/app/dashboard/base/municipio/')
+            self.assertEqual(save.call_count, 1)
+        client.get('/app/dashboard/base/estado/')
+        self.assertEqual(client.session['stack'], ['/app/dashboard/', '/app/dashboard/base/estado/'])
+
+
+class ParallelTestCase(TransactionTestCase):
+
+    def test_parallel_valueset(self):
+        from unittest import mock
+        from django.db import transaction
+        from django.utils import timezone, translation
+        loaddata()
+        servidor = Servidor.objects.get()
+        request = create_request(create_superuser())
+        calls = []
+
+        def count_ferias(self):
+            calls.append((threading.current_thread(), translation.get_language(), timezone.get_current_timezone_name()))
+            return Ferias.objects.filter(servidor=self).count()
+        Servidor.count_ferias_1 = Servidor.count_ferias_2 = count_ferias
+        names = 'count_ferias_1', 'get_ferias', 'nome', 'count_ferias_2', 'get_dados_gerais'
+        load = lambda parallel, wrap: servidor.value_set(*names).parallel(parallel).contextualize(request).load(wrap=wrap)
+        try:
+            with translation.override('en'), timezone.override('America/Sao_Paulo'):
+                data = load(True, False)
+            self.assertEqual(data, load(False, False))
+            self.assertEqual(data['count_ferias_1'], '2')
+            # the methods run on the pool with the language and the timezone of the request
+            self.assertEqual(len(calls), 4)
+            self.assertNotIn(threading.main_thread(), [thread for thread, _, _ in calls[0:2]])
+            self.assertEqual({(language, tz) for _, language, tz in calls[0:2]}, {('en', 'America/Sao_Paulo')})
+            # the output does not depend on the mode when the first attribute is skipped
+            with mock.patch.object(Servidor, 'has_attr_permission', lambda self, user, name: name != 'count_ferias_1'):
+                self.assertEqual(
+                    [(key, value.get('type')) for key, value in load(True, True).items()],
+                    [(key, value.get('type')) for key, value in load(False, True).items()]
+                )
+            # the writes of a transaction in progress are only visible to its own connection
+            calls.clear()
+            with transaction.atomic():
+                Ferias.objects.create(servidor=servidor, ano=2022, inicio=date(2022, 1, 1), fim=date(2022, 1, 31))
+                self.assertEqual(load(True, False)['count_ferias_1'], '3')
+            self.assertEqual([thread for thread, _, _ in calls], [threading.main_thread()] * 2)
+        finally:
+            del Servidor.count_ferias_1, Servidor.count_ferias_2
+
+
+class CacheTestCase(TestCase):
+
+    def test_table_versions(self):
+        from django.db.models.deletion import Collector
+        from sloth.core.cache import get_versions, tables_changed
+        loaddata()
+        table = Frequencia._meta.db_table
+        changes = []
+
+        def receiver(tables, **kwargs):
+            changes.extend(tables)
+        tables_changed.connect(receiver)
+        try:
+            with self.captureOnCommitCallbacks(execute=True):
+                versions = get_versions([table])
+                Frequencia.objects.create(servidor=Servidor.objects.first(), horario=datetime.now())
+                self.assertNotEqual(get_versions([table]), versions)
+                self.assertNotIn(table, changes)
+                versions = get_versions([table])
+        finally:
+            tables_changed.disconnect(receiver)
+        # bumped again once committed
+        self.assertNotEqual(get_versions([table]), versions)
+        self.assertIn(table, changes)
+        # fast deletes, including the cascaded ones, still touch the tables
+        self.assertTrue(Collector(using='default').can_fast_delete(Frequencia.objects.all()))
+        versions = get_versions([table])
+        Servidor.objects.first().delete()
+        self.assertNotEqual(get_versions([table]), versions)
+        versions = get_versions([table])
+        Frequencia.objects.all().delete()
+        self.assertNotEqual(get_versions([table]), versions)
+
+    @override_settings(COUNT_CACHE_TIMEOUT=60)
+    def test_count_cache(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        rn = Estado.objects.create(sigla='RN')
+        Municipio.objects.create(nome='Natal', estado=rn)
+        self.assertEqual(Municipio.objects.filter(estado__sigla='RN').count(), 1)
+        with CaptureQueriesContext(connection) as context:
+            self.assertEqual(Municipio.objects.filter(estado__sigla='RN').count(), 1)
+        self.assertEqual(len(context.captured_queries), 0)
+        Municipio.objects.create(nome='Mossoró', estado=rn)
+        self.assertEqual(Municipio.objects.filter(estado__sigla='RN').count(), 2)
+        Estado.objects.update(sigla='PB')
+        self.assertEqual(Municipio.objects.filter(estado__sigla='RN').count(), 0)
+        self.assertEqual(Municipio.objects.filter(pk__in=Municipio.objects.filter(estado__sigla='PB').values('pk')).count(), 2)
+        Municipio.objects.filter(nome='Natal').delete()
+        self.assertEqual(Municipio.objects.filter(pk__in=Municipio.objects.filter(estado__sigla='PB').values('pk')).count(), 1)
+
+    @override_settings(COUNT_CACHE_TIMEOUT=60)
+    def test_batched_counts(self):
+        from sloth.core.cache import cached_counts
+        rn = Estado.objects.create(sigla='RN')
+        Municipio.objects.create(nome='Natal', estado=rn)
+        Municipio.objects.create(nome='Mossoró', estado=rn)
+        querysets = [
+            Estado.objects.all(), Municipio.objects.filter(estado__sigla='RN').select_related('estado'),
+            Municipio.objects.filter(nome='Natal'), Municipio.objects.none()
+        ]
+        with self.assertNumQueries(1):
+            self.assertEqual(cached_counts(querysets), [1, 2, 1, 0])
+        with self.assertNumQueries(0):
+            self.assertEqual(cached_counts(querysets), [1, 2, 1, 0])
+        Municipio.objects.create(nome='Caicó', estado=rn)
+        with self.assertNumQueries(1):
+            self.assertEqual(cached_counts(querysets), [1, 3, 1, 0])
+
+    def test_shell_cache(self):
+        from sloth.core.queryset import SHELLS
+        rn = Estado.objects.create(sigla='RN')
+        Municipio.objects.create(nome='Natal', estado=rn)
+        user = create_superuser()
+        SHELLS.clear()
+        for value in ('', str(rn.pk)):
+            request = create_request(user, data=dict(estado=value) if value else None)
+            qs = Municipio.objects.all().display('nome').filters('estado').contextualize(request)
+            data = qs.serialize(path='/base/municipio/', wrap=True)
+            self.assertEqual(len(SHELLS.data), 1)
+        self.assertEqual(data['metadata']['filters']['estado']['value'], [None, str(rn.pk)])
+        self.assertEqual(list(data['metadata']['display']), ['nome'])
+
+    @override_settings(CACHE_STALE_TIMEOUT=60)
+    def test_attr_cache(self):
+        from sloth import meta
+        from sloth.core.cache import get_attr_cache_key, get_stale, set_stale
+
+        @meta('Total', cache=60, cache_scope='global', depends=('base.Municipio',))
+        def get_total():
+            return Municipio.objects.count()
+
+        @meta('Total', cache=60)
+        def get_total_por_usuario():
+            return Municipio.objects.count()
+
+        requests = [create_request(User.objects.create(username=username)) for username in ('u1', 'u2')]
+        key = get_attr_cache_key(get_total, requests[0], '/base/estado/1/')
+        self.assertEqual(key, get_attr_cache_key(get_total, requests[1], '/base/estado/1/'))
+        self.assertNotEqual(
+            get_attr_cache_key(get_total_por_usuario, requests[0], '/base/estado/1/'),
+            get_attr_cache_key(get_total_por_usuario, requests[1], '/base/estado/1/')
+        )
+        Municipio.objects.create(nome='Natal', estado=Estado.objects.create(sigla='RN'))
+        self.assertNotEqual(key, get_attr_cache_key(get_total, requests[0], '/base/estado/1/'))
+        set_stale(key, 1, -1)
+        self.assertIsNone(get_stale(key))
+        self.assertEqual(get_stale(key), 1)
+        set_stale(key, 2, 60)
+        self.assertEqual(get_stale(key), 2)
+
+    @override_settings(FRAGMENT_CACHE_TIMEOUT=60)
+    def test_fragment_cache(self):
+        Estado.objects.create(sigla='RN')
+        request = create_request(create_superuser(), '/app/dashboard/base/estado/')
+        html = Estado.objects.all().contextualize(request).html()
+        with self.assertNumQueries(0):
+            self.assertEqual(Estado.objects.all().contextualize(request).html(), html)
+        Estado.objects.create(sigla='PB')
+        self.assertIn('PB', Estado.objects.all().contextualize(request).html())
+
+    @override_settings(FRAGMENT_CACHE_TIMEOUT=60, FRAGMENT_CACHE_SCOPE='role')
+    def test_fragment_cache_owner(self):
+        from sloth.api.models import Role
+        from sloth.core.cache import cached_fragment, get_fragment_key
+        users = [User.objects.create(username=username) for username in ('u1', 'u2')]
+        for user, scope_value in zip(users, (1, 2)):
+            Role.objects.create(user=user, name='Gestor', scope_key='estado', scope_value=scope_value)
+        users = [User.objects.get(pk=user.pk) for user in users]
+        self.assertNotEqual(get_fragment_key(create_request(users[0])), get_fragment_key(create_request(users[1])))
+
+        class Form:
+            calls = 0
+            request = create_request(users[0])
+
+            def get_fragment_identifiers(self):
+                return ()
+
+            @cached_fragment
+            def html(self, path=None, print=False):
+                self.calls += 1
+                return '<input type="hidden" name="csrfmiddlewaretoken" value="{}">'.format(self.calls)
+        form = Form()
+        self.assertNotEqual(form.html(), form.html())
+
+    @override_settings(DASHBOARD_CACHE_TIMEOUT=60, DEPLOY_TOKEN='1.0')
+    def test_dashboard_skeleton(self):
+        from django.contrib.sessions.backends.cache import SessionStore
+        import time
+        from unittest import mock
+        from django.core.cache import cache
+        from sloth.api.dashboard import Dashboards
+        from sloth.api.models import Role
+        from sloth.core.cache import check_deploy_token
+        user = create_superuser()
+
+        def dashboards():
+            request = create_request(User.objects.get(pk=user.pk), '/app/dashboard/base/estado/')
+            request.session = SessionStore()
+            return Dashboards(request)
+        data = dashboards().data
+        cached = dashboards()
+        self.assertTrue(cached.request.dashboard_skeleton)
+        self.assertEqual(cached.data['menu'], data['menu'])
+        self.assertEqual(cached.data['search'], data['search'])
+        self.assertEqual(cached.data['styles'], data['styles'])
+        # the settings menu is computed for each request
+        self.assertEqual([item['label'] for item in cached.data['settings']], [item['label'] for item in data['settings']])
+        self.assertTrue(cached.data['settings'])
+        Role.objects.create(user=user, name='Gerente')
+        self.assertFalse(dashboards().request.dashboard_skeleton)
+        with override_settings(DEPLOY_TOKEN=None):
+            self.assertEqual([error.id for error in check_deploy_token(None)], ['sloth.E001'])
+            dashboards()
+            self.assertFalse(dashboards().request.dashboard_skeleton)
+        self.assertEqual(check_deploy_token(None), [])
+        # the values read by the manifest, the icon views and the login form do not expire while the skeleton, which
+        # skips setting them, is still cached
+        with mock.patch('django.core.cache.backends.locmem.time.time', return_value=time.time() + 3600):
+            self.assertEqual(cache.get('title'), 'Petshop')
+            self.assertIsNotNone(cache.get('login'))
+
+    @override_settings(CREDENTIAL_CACHE_TIMEOUT=60, API_KEYS={'0123456789': 'robot'})
+    def test_credential_cache(self):
+        import base64
+        from datetime import timedelta
+        from django.contrib.auth.models import AnonymousUser
+        from oauth2_provider.models import AccessToken
+        from django.core.cache import cache
+        from sloth.api.views import is_authenticated
+        from sloth.core.cache import get_credential_key
+
+        def authenticated(authorization):
+            request = create_request(AnonymousUser(), '/api/dashboard/', HTTP_AUTHORIZATION=authorization)
+            return is_authenticated(request) and request.user.username
+        user = User.objects.create(username='admin')
+        user.set_password('123')
+        user.save()
+        basic = 'Basic {}'.format(base64.b64encode(b'admin:123').decode())
+        self.assertEqual(authenticated(basic), 'admin')
+        # the user is fetched by its pk instead of verifying the password again
+        with self.assertNumQueries(1):
+            self.assertEqual(authenticated(basic), 'admin')
+        self.assertNotIn('pbkdf2', str(cache.get(get_credential_key(basic))))
+        user.set_password('456')
+        user.save()
+        self.assertFalse(authenticated(basic))
+        access_token = AccessToken.objects.create(user=user, token='abc', expires=datetime.now() + timedelta(days=1))
+        self.assertEqual(authenticated('Token abc'), 'admin')
+        with self.assertNumQueries(1):
+            self.assertEqual(authenticated('Token abc'), 'admin')
+        access_token.delete()
+        self.assertFalse(authenticated('Token abc'))
+        robot = User.objects.create(username='robot')
+        self.assertEqual(authenticated('ApiKey 0123456789'), 'robot')
+        with self.assertNumQueries(0):
+            self.assertEqual(authenticated('ApiKey 0123456789'), 'robot')
+        self.assertFalse(authenticated('ApiKey 9876543210'))
+        robot.is_active = False
+        robot.save()
+        self.assertFalse(authenticated('ApiKey 0123456789'))
+
+    def test_etag_of_cached_values(self):
+        from django.test import Client
+        estado = Estado.objects.create(sigla='RN')
+        path = '/api/dashboard/base/estado/{}/get_total_municipios/'.format(estado.pk)
+        clients = []
+        for username in ('a', 'b'):
+            clients.append(Client())
+            clients[-1].force_login(create_superuser(username))
+        clients[0].get(path)
+        # the value is served to the second user from the attribute cache, without running any query
+        response = clients[1].get(path)
+        self.assertIn('ETag', response)
+        Municipio.objects.create(nome='Natal', estado=estado)
+        response = clients[1].get(path, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 200)
+
+    def test_etag_of_streams(self):
+        from django.test import Client
+        Estado.objects.create(sigla='RN')
+        client = Client()
+        client.force_login(create_superuser())
+        path = '/api/dashboard/base/estado/'
+        response = client.get(path)
+        self.assertIn('Accept', response['Vary'])
+        etag = response['ETag']
+        self.assertEqual(client.get(path, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        # the ndjson representation of the same url is not answered with the etag of the json one
+        response = client.get(path, HTTP_IF_NONE_MATCH=etag, HTTP_ACCEPT='application/x-ndjson')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        self.assertIn('Accept', response['Vary'])
+
+    def test_warmer(self):
+        from django.core.cache import cache
+        from sloth.core.cache import get_attr_cache_key, get_fresh
+        from sloth.core.warmer import LAST_SLOT_KEY, LOCK_KEY, get_recipes, warm_all
+        cache.clear()
+        estado = Estado.objects.create(sigla='RN')
+        request = create_request(create_superuser('u1'), '/api/base/estado/{}/'.format(estado.pk))
+        path = '{}get_total_municipios/'.format(request.path)
+        valueset = estado.value_set('get_total_municipios').contextualize(request).load(wrap=False)
+        self.assertEqual(valueset['get_total_municipios'], '0')
+        self.assertEqual(len(get_recipes()), 1)
+        Municipio.objects.create(nome='Natal', estado=estado)
+        self.assertIsNone(get_fresh(get_attr_cache_key(Estado.get_total_municipios, request, path)))
+        # another process is running the round
+        cache.add(LOCK_KEY, 1)
+        self.assertEqual(warm_all(), 0)
+        cache.delete(LOCK_KEY)
+        self.assertEqual(warm_all(), 1)
+        self.assertEqual(get_fresh(get_attr_cache_key(Estado.get_total_municipios, request, path)), '1')
+        # registering the same attribute again does not take a new slot
+        Municipio.objects.create(nome='Parnamirim', estado=estado)
+        valueset = estado.value_set('get_total_municipios').contextualize(request).load(wrap=False)
+        self.assertEqual(valueset['get_total_municipios'], '2')
+        self.assertEqual(len(get_recipes()), 1)
+        self.assertEqual(cache.get(LAST_SLOT_KEY), 1)
+        # expired recipes are no longer warmed
+        with override_settings(WARMER_RECIPE_TIMEOUT=-1):
+            cache.clear()
+            estado.value_set('get_total_municipios').contextualize(request).load(wrap=False)
+        self.assertEqual(get_recipes(), {})
+        self.assertEqual(warm_all(), 0)
+        cache.clear()
+
+    def test_warmer_of_role_scope(self):
+        from django.core.cache import cache
+        from sloth.api.models import Role
+        from sloth.core.cache import get_attr_cache_key, get_fresh
+        from sloth.core.warmer import get_recipes, warm_all
+        cache.clear()
+        estado = Estado.objects.create(sigla='RN')
+        path = '/api/base/estado/{}/'.format(estado.pk)
+        requests = []
+        for username, role in (('u1', 'Gerente'), ('u2', 'Chefe'), ('u3', 'Chefe')):
+            user = create_superuser(username)
+            Role.objects.create(user=user, name=role)
+            requests.append(create_request(User.objects.get(pk=user.pk), path))
+        Estado.get_total_municipios.__cache_scope__ = 'role'
+        try:
+            for request in requests:
+                estado.value_set('get_total_municipios').contextualize(request).load(wrap=False)
+            # one recipe for each set of roles
+            self.assertEqual(len(get_recipes()), 2)
+            Municipio.objects.create(nome='Natal', estado=estado)
+            self.assertEqual(warm_all(), 2)
+            for request in requests:
+                key = get_attr_cache_key(Estado.get_total_municipios, request, '{}get_total_municipios/'.format(path))
+                self.assertEqual(get_fresh(key), '1')
+        finally:
+            Estado.get_total_municipios.__cache_scope__ = 'global'
+            cache.clear()
+
 
 class LoginTestCase(ServerTestCase):
     def test_api(self):
@@ -136,6 +816,25 @@ class ApiTestCase(ServerTestCase):
         # self.post('/api/dashboard/auth/group/1/delete/')
 
         self.get('/api/dashboard/base/servidor/')
+        self.assertEqual(len(self.get('/api/dashboard/base/servidor/?stream=json')), 1)
+
+        import requests
+        Estado.objects.create(sigla='PE')
+        Estado.objects.create(sigla='CE')
+        url, headers = self.url('/api/dashboard/base/estado/'), self.get_headers()
+        expected = [(str(pk), sigla) for pk, sigla in Estado.objects.order_by('id').values_list('id', 'sigla')]
+        for response in (
+            requests.get('{}?stream=ndjson'.format(url), headers=headers, stream=True),
+            requests.get(url, headers=dict(headers, Accept='application/x-ndjson'), stream=True)
+        ):
+            self.assertEqual(response.headers['Content-Type'], 'application/x-ndjson')
+            lines = [json.loads(line) for line in response.iter_lines()]
+            self.assertEqual([(row['id'], row['sigla']) for row in lines], expected)
+            self.assertTrue(all('cidades_metropolitanas' in row for row in lines))
+        etag = requests.get(url, headers=headers).headers['ETag']
+        self.assertEqual(requests.get(url, headers=dict(headers, **{'If-None-Match': etag})).status_code, 304)
+        Estado.objects.create(sigla='PB')
+        self.assertEqual(requests.get(url, headers=dict(headers, **{'If-None-Match': etag})).status_code, 200)
         self.get('/api/dashboard/base/servidor/ativos/')
         self.post('/api/dashboard/base/servidor/0-1/inativar_servidores/')
         self.get('/api/dashboard/base/servidor/ativos/')
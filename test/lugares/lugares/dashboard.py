@@ -25,7 +25,7 @@ class AppDashboard(Dashboard):
     def get_estados(self):
         return self.objects('lugares.estado')
 
-    @meta('Indicadores', renderer='statistics/cards', assyncronous=True, cache=15)
+    @meta('Indicadores', renderer='statistics/cards', assyncronous=True, cache=15, warm=True)
     def get_indicadores(self):
         time.sleep(3)
         return [
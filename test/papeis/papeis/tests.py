@@ -71,4 +71,18 @@ class AppTestCase(TestCase):
         user_f4 = User.objects.get(username='f4')
         for user in (user_f1, user_f2, user_d1, user_f4):
             self.print(user, Produto.objects.all().apply_role_lookups(user))
-            self.print(user, Produto.objects.all().apply_role_lookups(user).has_permission(user))
\ No newline at end of file
+            self.print(user, Produto.objects.all().apply_role_lookups(user).has_permission(user))
+
+    def test_role_context(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        user_d1 = User.objects.get(username='d1')
+        r1, r2 = Rede.objects.get(nome='r1'), Rede.objects.get(nome='r2')
+        Rede.objects.role_lookups('Diretor', pk='rede').apply_role_lookups(user_d1)
+        with CaptureQueriesContext(connection) as context:
+            qs = Loja.objects.role_lookups('Diretor', rede='rede').apply_role_lookups(user_d1)
+            self.assertTrue(r1.role_lookups('Diretor', pk='rede').apply(user_d1))
+            self.assertFalse(r2.role_lookups('Diretor', pk='rede').apply(user_d1))
+            self.assertTrue(user_d1.roles.contains('Diretor'))
+        self.assertEqual(len(context.captured_queries), 0)
+        self.assertEqual(qs.count(), 2)